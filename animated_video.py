@@ -1,20 +1,88 @@
 import argparse
+import math
+import os
+import subprocess
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from moviepy.video.VideoClip import VideoClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 from moviepy.audio.io.AudioFileClip import AudioFileClip
-from PIL import Image
+from moviepy.config import FFMPEG_BINARY
+from PIL import Image, ImageFile
 
-def configure_parameters(image_path, audio_path, grid_width=10):
-    image = Image.open(image_path)
+import mosaic
+
+def build_pyramid(image, min_width, min_height, scale=1.0):
+    """
+    Mip-style pyramid of the source: each level is half the size of the previous one,
+    down to the first level that still covers (min_width, min_height).
+    scale is the size of image relative to the source coordinates (less than 1.0 when
+    the source was decoded at a reduced size).
+    Returns a list of (scale, image) pairs, from the largest image down.
+    """
+    levels = [(scale, image)]
+    while image.width // 2 >= min_width and image.height // 2 >= min_height:
+        image = image.reduce(2)
+        scale /= 2
+        levels.append((scale, image))
+    return levels
+
+def pyramid_level(params, scale):
+    """Smallest pyramid level whose scale is still >= the requested one."""
+    for level_scale, level_image in reversed(params["pyramid"]):
+        if level_scale >= scale:
+            return level_scale, level_image
+    return params["pyramid"][0]
+
+def configure_parameters(image_path, audio_path, grid_width=10, placement_path=None):
     audio = AudioFileClip(audio_path)
+    params = frame_parameters(image_path, audio.duration, grid_width, placement_path)
+    params["audio"] = audio
+    return params
 
-    image_width, image_height = image.size
+def frame_parameters(image_path, total_duration, grid_width=10, placement_path=None):
+    """
+    Everything make_frame needs to render a frame of a video of total_duration seconds.
+    It doesn't depend on the audio clip, so frame rendering workers can build it too.
+
+    With placement_path (the map saved by mosaic.py --placement-map), image_path is the
+    mosaic, which is only decoded at a reduced size for the wide shots; close-ups are
+    composed from the source photos of the tiles, and sectors are aligned to the tile grid.
+    """
+    image = Image.open(image_path)
+    placement = None
+    if placement_path:
+        placement = mosaic.load_placement_map(placement_path)
+        tile_width, tile_height = placement["tile_size"]
+        grid_cols, grid_rows = placement["grid"]
+        # Coordinates are always in full-size mosaic pixels, whatever size image_path has
+        image_width, image_height = grid_cols * tile_width, grid_rows * tile_height
+    else:
+        image_width, image_height = image.size
 
     # We use 1080p as base for video height
     video_height = 1080
     video_width = int((video_height / image_height) * image_width)
 
-    total_duration = audio.duration
+    if placement:
+        # A JPEG mosaic is decoded at 1/2, 1/4 or 1/8 of its size, as long as it still
+        # covers twice the video resolution
+        image.draft("RGB", (video_width * 2, video_height * 2))
+    image = image.convert("RGB")
+
+    if placement:
+        # Sectors are whole blocks of tiles with the shape of the video frame
+        cells_x = max(1, grid_cols // grid_width)
+        sector_width = cells_x * tile_width
+        cells_y = max(1, round(sector_width * video_height / video_width / tile_height))
+        sector_height = cells_y * tile_height
+        grid_width = grid_cols // cells_x
+        grid_height = max(1, grid_rows // cells_y)
+    else:
+        sector_width = image_width // grid_width
+        grid_height = image_height // sector_width
+        sector_height = image_height // grid_height
 
     # Static phases (initial/final)
     static_duration = min(total_duration * 0.1, 5)
@@ -22,9 +90,7 @@ def configure_parameters(image_path, audio_path, grid_width=10):
 
     remaining_time = total_duration - static_duration - final_static_duration
     zoom_out_duration = remaining_time * 0.1
-    zoom_duration_per_sector = (remaining_time - zoom_out_duration) / (
-        grid_width * (image_height // (image_width // grid_width))
-    )
+    zoom_duration_per_sector = (remaining_time - zoom_out_duration) / (grid_width * grid_height)
 
     fps = 24
 
@@ -38,7 +104,7 @@ def configure_parameters(image_path, audio_path, grid_width=10):
     scale_h = video_height / image_height
     final_scale = min(scale_w, scale_h)  # so the whole image fits
 
-    return {
+    params = {
         "image": image,
         "image_width": image_width,
         "image_height": image_height,
@@ -49,110 +115,183 @@ def configure_parameters(image_path, audio_path, grid_width=10):
         "zoom_out_duration": zoom_out_duration,
         "final_static_duration": final_static_duration,
         "fps": fps,
-        "audio": audio,
         "grid_width": grid_width,
-        "grid_height": image_height // (image_width // grid_width),
+        "grid_height": grid_height,
+        "sector_width": sector_width,
+        "sector_height": sector_height,
         "final_scale": final_scale,  # factor de escala para la fase estática
+        # Every frame is resampled from the nearest level instead of the full-size image
+        "pyramid": build_pyramid(image, video_width, video_height, image.width / image_width),
+        # Viewport and image of the last rendered frame
+        "cache": {},
     }
+    if placement:
+        params["placement"] = placement
+        params["base_image"] = mosaic.correct_image_orientation(Image.open(placement["base_image"]))
+    return params
 
-def static_frame(t, params):
+def render_viewport(params, viewport):
     """
-    Shows the image at 'final_scale' so that it fits inside the
-    (video_width, video_height) area, then center-crops if needed.
+    Renders the (video_width, video_height) frame that shows viewport, a
+    (left, upper, right, lower) rectangle in source pixel coordinates that may be
+    fractional or extend past the image (that area is black).
     """
-    image = params["image"]
-    scale = params["final_scale"]
-
-    # Compute new image size
-    new_width = int(image.width * scale)
-    new_height = int(image.height * scale)
-
-    # Resize the original image
-    resized_image = image.resize((new_width, new_height), Image.LANCZOS)
+    left, upper, right, lower = viewport
+    size = (params["video_width"], params["video_height"])
+    scale_x = size[0] / (right - left)
+    scale_y = size[1] / (lower - upper)
+
+    visible = (max(left, 0), max(upper, 0), min(right, params["image_width"]), min(lower, params["image_height"]))
+    if visible == viewport:
+        return sample_region(params, visible, size)
+
+    # Part of the viewport is outside the image: sample the visible part into its place
+    frame = Image.new("RGB", size)
+    frame_box = (
+        round((visible[0] - left) * scale_x), round((visible[1] - upper) * scale_y),
+        round((visible[2] - left) * scale_x), round((visible[3] - upper) * scale_y),
+    )
+    if frame_box[2] > frame_box[0] and frame_box[3] > frame_box[1]:
+        part = sample_region(params, visible, (frame_box[2] - frame_box[0], frame_box[3] - frame_box[1]))
+        frame.paste(part, frame_box[:2])
+    return frame
 
-    # If it is larger than (video_width, video_height), crop the center
-    x_offset = max(0, (new_width - params["video_width"]) // 2)
-    y_offset = max(0, (new_height - params["video_height"]) // 2)
-    right = x_offset + params["video_width"]
-    lower = y_offset + params["video_height"]
+def sample_region(params, region, size):
+    """
+    Resamples region (inside the source) to size in one pass from the closest pyramid
+    level: resize() with a fractional box is an axis-aligned affine transform, so only
+    output pixels are computed and the cost depends on the output size, not on the
+    source size. With a placement map, regions that need more detail than the decoded
+    mosaic has are composed from the tiles instead.
+    """
+    left, upper, right, lower = region
+    scale = max(size[0] / (right - left), size[1] / (lower - upper))
+    if "placement" in params and scale > params["pyramid"][0][0]:
+        return compose_tiles(params, region, size)
+
+    _, level_image = pyramid_level(params, scale)
+    level_x = level_image.width / params["image_width"]
+    level_y = level_image.height / params["image_height"]
+    return level_image.resize(
+        size, Image.BILINEAR, box=(left * level_x, upper * level_y, right * level_x, lower * level_y)
+    )
 
-    cropped = resized_image.crop((x_offset, y_offset, right, lower))
+def load_placement_tile(source, tile_path, size, tile_size):
+    """
+    A tile at size: from the processed tile file when size fits within its tile_size,
+    otherwise cropped from its full-resolution source photo when it is still available.
+    """
+    if (size[0] > tile_size[0] or not os.path.exists(tile_path)) and source and os.path.exists(source):
+        return mosaic.render_tile(source, size)
+    with Image.open(tile_path) as tile:
+        tile = tile.convert("RGB")
+        return tile if tile.size == size else tile.resize(size, Image.BICUBIC)
 
-    return np.array(cropped)
+def compose_tiles(params, region, size):
+    """
+    Renders region of the mosaic at size by pasting the tiles of the cells it covers,
+    each one scaled from its source photo, and overlaying the base image as mosaic.py does.
+    The decoded tiles of the previous frame are kept for the next one: only the tiles
+    that come into view (or change decoded size) are decoded again, however many are visible.
+    """
+    placement = params["placement"]
+    tile_width, tile_height = placement["tile_size"]
+    grid_cols, grid_rows = placement["grid"]
+    left, upper, right, lower = region
+    scale_x = size[0] / (right - left)
+    scale_y = size[1] / (lower - upper)
+
+    # Tiles are decoded at the next power of two of their on-screen width, so a zoom
+    # reuses the same decoded tiles for many frames
+    cell_size = (math.ceil(tile_width * scale_x), math.ceil(tile_height * scale_y))
+    decoded_width = 2 ** math.ceil(math.log2(cell_size[0]))
+    decoded_size = (decoded_width, max(1, round(decoded_width * tile_height / tile_width)))
+
+    previous_tiles = params["cache"].get("tiles", {})
+    visible_tiles = {}
+    frame = Image.new("RGB", size)
+    for row in range(int(upper // tile_height), min(grid_rows, math.ceil(lower / tile_height))):
+        for col in range(int(left // tile_width), min(grid_cols, math.ceil(right / tile_width))):
+            tile_index = placement["cells"][row * grid_cols + col]
+            key = (tile_index, decoded_size)
+            tile_image = visible_tiles.get(key) or previous_tiles.get(key)
+            if tile_image is None:
+                tile = placement["tiles"][tile_index]
+                tile_image = load_placement_tile(
+                    tile["source"], tile["tile"], decoded_size, (tile_width, tile_height)
+                )
+            visible_tiles[key] = tile_image
+            frame.paste(
+                tile_image.resize(cell_size, Image.BILINEAR),
+                (round((col * tile_width - left) * scale_x), round((row * tile_height - upper) * scale_y)),
+            )
+
+    base_image = params["base_image"]
+    base_x = base_image.width / params["image_width"]
+    base_y = base_image.height / params["image_height"]
+    params["cache"]["tiles"] = visible_tiles
+    overlay = base_image.resize(
+        size, Image.BILINEAR, box=(left * base_x, upper * base_y, right * base_x, lower * base_y)
+    ).convert("RGBA")
+    frame = mosaic.apply_overlay(frame.convert("RGBA"), overlay, placement["opacity"], placement["blend"])
+    return frame.convert("RGB")
+
+def static_viewport(t, params):
+    """
+    Shows the image at 'final_scale' so that it fits inside the
+    (video_width, video_height) area, centered if it is larger.
+    """
+    scale = params["final_scale"]
+    width = params["video_width"] / scale
+    height = params["video_height"] / scale
+    left = max(0.0, (params["image_width"] - width) / 2)
+    upper = max(0.0, (params["image_height"] - height) / 2)
+    return (left, upper, left + width, upper + height)
 
-def zoom_to_sector_frame(t, params, sector_index):
+def zoom_to_sector_viewport(t, params, sector_index):
     """
     Zoom from normal (1:1) up to 1.5x for each sector, with a linear factor
-    from 1.0 to 1.0 + zoom_ratio.
+    from 1.0 to 1.0 + zoom_ratio. At 1:1 the sector fills the whole frame.
     """
-    grid_width, grid_height = params["grid_width"], params["grid_height"]
-    sector_width = params["image_width"] // grid_width
-    sector_height = params["image_height"] // grid_height
-
-    col = sector_index % grid_width
-    row = sector_index // grid_width
-
-    left = col * sector_width
-    upper = row * sector_height
-    right = left + sector_width
-    lower = upper + sector_height
-
-    cropped_image = params["image"].crop((left, upper, right, lower))
-
     # For example, we do a 0.5 zoom ratio (1.0 => 1.5).
     zoom_ratio = 0.5
     progress = t / params["zoom_duration_per_sector"]
     zoom_level = 1.0 + zoom_ratio * progress  # from 1.0 to 1.5
 
-    # Resize based on zoom_level but then center-crop to (video_width, video_height)
-    resized_image = cropped_image.resize(
-        (
-            int(params["video_width"] * zoom_level),
-            int(params["video_height"] * zoom_level),
-        ),
-        Image.LANCZOS,
-    )
-
-    x_offset = (resized_image.width - params["video_width"]) // 2
-    y_offset = (resized_image.height - params["video_height"]) // 2
+    grid_width = params["grid_width"]
+    sector_width = params["sector_width"]
+    sector_height = params["sector_height"]
+    center_x = (sector_index % grid_width + 0.5) * sector_width
+    center_y = (sector_index // grid_width + 0.5) * sector_height
 
-    cropped_zoom = resized_image.crop(
-        (x_offset, y_offset, x_offset + params["video_width"], y_offset + params["video_height"])
-    )
+    # The visible part of the sector shrinks around its center as the zoom grows
+    half_width = sector_width / zoom_level / 2
+    half_height = sector_height / zoom_level / 2
+    return (center_x - half_width, center_y - half_height, center_x + half_width, center_y + half_height)
 
-    return np.array(cropped_zoom)
-
-def zoom_out_frame(t, params):
+def zoom_out_viewport(t, params):
     """
     Smoothly go from a bigger zoom (e.g. 4x) down to final_scale,
-    so it ends exactly matching the static_frame's scale.
+    so it ends exactly matching the static frame's viewport.
     """
     start_zoom = 4.0  # you can tweak this if you want more or less initial "big zoom"
-    end_zoom = params["final_scale"]  # it ends at the same scale as static_frame
+    end_zoom = params["final_scale"]  # it ends at the same scale as the static frame
 
     progress = t / params["zoom_out_duration"]
     # Linear interpolation between start_zoom and end_zoom
     current_zoom = start_zoom + (end_zoom - start_zoom) * progress
 
-    # Now resize the original image with this current_zoom factor
-    new_width = int(params["image_width"] * current_zoom)
-    new_height = int(params["image_height"] * current_zoom)
-
-    resized_image = params["image"].resize((new_width, new_height), Image.LANCZOS)
-
-    # Center-crop to the video dimension
-    x_offset = max(0, (new_width - params["video_width"]) // 2)
-    y_offset = max(0, (new_height - params["video_height"]) // 2)
-    right = x_offset + params["video_width"]
-    lower = y_offset + params["video_height"]
+    # Centered on the image while it is larger than the video
+    width = params["video_width"] / current_zoom
+    height = params["video_height"] / current_zoom
+    left = max(0.0, (params["image_width"] - width) / 2)
+    upper = max(0.0, (params["image_height"] - height) / 2)
+    return (left, upper, left + width, upper + height)
 
-    cropped_zoom = resized_image.crop((x_offset, y_offset, right, lower))
-
-    return np.array(cropped_zoom)
-
-def make_frame(t, params):
+def camera_viewport(t, params):
+    """The camera path: the source rectangle shown at time t."""
     if t < params["static_duration"]:
-        return static_frame(t, params)
+        return static_viewport(t, params)
 
     t -= params["static_duration"]
 
@@ -162,20 +301,103 @@ def make_frame(t, params):
     if t < total_zoom_duration:
         sector_index = int(t / params["zoom_duration_per_sector"])
         sector_t = t % params["zoom_duration_per_sector"]
-        return zoom_to_sector_frame(sector_t, params, sector_index)
+        return zoom_to_sector_viewport(sector_t, params, sector_index)
 
     t -= total_zoom_duration
 
     if t < params["zoom_out_duration"]:
-        return zoom_out_frame(t, params)
+        return zoom_out_viewport(t, params)
 
     t -= params["zoom_out_duration"]
 
     # Final static phase
-    return static_frame(t, params)
+    return static_viewport(t, params)
+
+def make_frame(t, params):
+    return np.array(frame_image(t, params))
+
+def frame_image(t, params):
+    """
+    The frame at time t as a (video_width, video_height) RGB image. Consecutive frames
+    with the same viewport (the static phases) are rendered only once.
+    """
+    viewport = camera_viewport(t, params)
+    cache = params["cache"]
+    if cache.get("viewport") != viewport:
+        cache["viewport"] = viewport
+        cache["frame"] = render_viewport(params, viewport)
+    return cache["frame"]
+
+# Parallel rendering: frames are pure functions of (t, params), so worker processes
+# build their own params once and render whole frames by index.
+_worker_params = None
+
+def init_frame_worker(image_path, total_duration, grid_width, placement_path):
+    global _worker_params
+    _worker_params = frame_parameters(image_path, total_duration, grid_width, placement_path)
+
+def render_frame(frame_index):
+    return make_frame(frame_index / _worker_params["fps"], _worker_params)
+
+def render_frames_parallel(image_path, params, total_duration, workers, grid_width=10, placement_path=None):
+    """
+    Yields every frame of the video in order, rendered ahead by a pool of workers.
+    At most workers * 2 frames are in flight; frames that finish early wait in that
+    queue (the reorder buffer) until all previous frames have been yielded.
+    """
+    total_frames = int(total_duration * params["fps"])
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_frame_worker,
+        initargs=(image_path, total_duration, grid_width, placement_path),
+    ) as executor:
+        pending = deque()
+        next_frame = 0
+        while next_frame < total_frames or pending:
+            while next_frame < total_frames and len(pending) < workers * 2:
+                pending.append(executor.submit(render_frame, next_frame))
+                next_frame += 1
+            yield pending.popleft().result()
+
+class FfmpegPipeWriter:
+    """
+    Feeds raw RGB frames to an ffmpeg subprocess through its stdin and muxes the audio
+    file in the same run. Images are encoded straight into the pipe by Pillow's raw
+    encoder, so frames are never copied into intermediate arrays or byte strings.
+    """
 
-def create_video(image_path, output_video, audio_path):
-    params = configure_parameters(image_path, audio_path)
+    def __init__(self, output_video, size, fps, audio_path=None, codec="libx264",
+                 audio_codec="aac", preset="medium", threads=0, buffer_size=1 << 20):
+        self.size = size
+        self.buffer_size = buffer_size
+        command = [
+            FFMPEG_BINARY, "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{size[0]}x{size[1]}", "-r", str(fps), "-i", "-",
+        ]
+        if audio_path:
+            command += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:a", audio_codec, "-shortest"]
+        command += [
+            "-c:v", codec, "-preset", preset, "-threads", str(threads), "-pix_fmt", "yuv420p", output_video,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+
+    def write_image(self, image):
+        ImageFile._save(
+            image, self.process.stdin, [("raw", (0, 0) + self.size, 0, ("RGB", 0, 1))], self.buffer_size
+        )
+
+    def write_frame(self, frame):
+        self.process.stdin.write(frame)
+
+    def close(self):
+        self.process.stdin.close()
+        error = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise IOError(f"ffmpeg failed writing the video:\n{error.decode(errors='replace')}")
+
+def create_video(image_path, output_video, audio_path, workers=1, backend="moviepy", preset="medium", threads=0,
+                 grid_width=10, placement_path=None):
+    params = configure_parameters(image_path, audio_path, grid_width, placement_path)
 
     total_duration = (
         params["static_duration"]
@@ -183,19 +405,36 @@ def create_video(image_path, output_video, audio_path):
         + params["zoom_out_duration"]
         + params["final_static_duration"]
     )
-
-    video = VideoClip(lambda t: make_frame(t, params), duration=total_duration)
-    video = video.with_fps(params["fps"])
-
-    # The .resized() call at the end can be omitted, because we're already
-    # generating frames at (video_width, video_height). But if you want to ensure
-    # a final pass, you can keep it. It shouldn't cause a jump because all frames
-    # are already (video_width, video_height).
-    video = video.resized((params["video_width"], params["video_height"]))
-
-    video = video.with_audio(params["audio"])
-
-    video.write_videofile(output_video, codec="libx264", audio_codec="aac")
+    size = (params["video_width"], params["video_height"])
+
+    if backend == "pipe":
+        writer = FfmpegPipeWriter(output_video, size, params["fps"], audio_path, preset=preset, threads=threads)
+    elif workers > 1:
+        writer = FFMPEG_VideoWriter(
+            output_video, size, params["fps"], codec="libx264", audiofile=audio_path, audio_codec="aac",
+            preset=preset, threads=threads or None,
+        )
+    else:
+        # Frames are already generated at (video_width, video_height), so no final resize pass is needed
+        video = VideoClip(lambda t: make_frame(t, params), duration=total_duration)
+        video = video.with_fps(params["fps"])
+        video = video.with_audio(params["audio"])
+        video.write_videofile(output_video, codec="libx264", audio_codec="aac", preset=preset, threads=threads or None)
+        print(f"¡Video generado exitosamente en {output_video}!")
+        return
+
+    try:
+        if workers > 1:
+            # Frames are computed ahead by the pool and streamed in order to ffmpeg,
+            # which muxes the audio file directly.
+            frames = render_frames_parallel(image_path, params, total_duration, workers, grid_width, placement_path)
+            for frame in frames:
+                writer.write_frame(frame)
+        else:
+            for frame_index in range(int(total_duration * params["fps"])):
+                writer.write_image(frame_image(frame_index / params["fps"], params))
+    finally:
+        writer.close()
     print(f"¡Video generado exitosamente en {output_video}!")
 
 if __name__ == "__main__":
@@ -203,6 +442,20 @@ if __name__ == "__main__":
     parser.add_argument("image_path", help="Ruta de la imagen de entrada")
     parser.add_argument("output_video", help="Ruta del video de salida")
     parser.add_argument("audio_path", help="Ruta del archivo de audio")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Procesos que renderizan fotogramas por adelantado (1 = renderizar en el bucle del codificador)")
+    parser.add_argument("--backend", choices=("moviepy", "pipe"), default="moviepy",
+                        help="pipe envía los fotogramas sin comprimir directamente a un proceso de ffmpeg, sin pasar por moviepy")
+    parser.add_argument("--preset", default="medium",
+                        help="Preset de x264: los más rápidos codifican antes pero generan archivos más grandes (ultrafast ... veryslow)")
+    parser.add_argument("--threads", type=int, default=0, help="Hilos del codificador (0 = los decide ffmpeg)")
+    parser.add_argument("--grid-width", type=int, default=10, help="Sectores por fila en los que se hace zoom uno tras otro")
+    parser.add_argument("--placement",
+                        help="Mapa de teselas guardado por mosaic.py --placement-map: image_path es ese mosaico y "
+                             "los primeros planos se componen con las fotos originales de sus teselas")
     args = parser.parse_args()
 
-    create_video(args.image_path, args.output_video, args.audio_path)
+    create_video(
+        args.image_path, args.output_video, args.audio_path, args.workers, args.backend, args.preset, args.threads,
+        args.grid_width, args.placement,
+    )
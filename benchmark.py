@@ -0,0 +1,232 @@
+"""
+Benchmark reproducible del pipeline de mosaic.py sobre datos sintéticos.
+
+Genera una biblioteca de fotos y una imagen base sintéticas (deterministas a partir de
+--seed) y mide cada etapa por separado: process_tiles (en frío y con la caché ya
+generada), load_tiles, cálculo de colores y asignación, composición y codificación.
+Para cada etapa registra el tiempo, el rendimiento y el pico de memoria (RSS) en un
+informe JSON.
+
+Ejemplos:
+    python benchmark.py
+    python benchmark.py --tiles 5000 --width 8000 --assign blocked --report bench.json
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import mosaic
+from instrumentation import PeakRssSampler, peak_rss
+
+
+def generate_tile_library(folder, count, size, seed):
+    """Crea count fotos JPEG/PNG con un color dominante, un degradado y ruido."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(-40, 40, width)[None, :, None]
+    for i in range(count):
+        subfolder = os.path.join(folder, f"album_{i % 10}")
+        os.makedirs(subfolder, exist_ok=True)
+        color = rng.integers(0, 256, 3)
+        noise = rng.normal(0, 20, (-(-height // 8), -(-width // 8), 3)).repeat(8, axis=0).repeat(8, axis=1)
+        pixels = np.clip(color + gradient + noise[:height, :width], 0, 255).astype(np.uint8)
+        image = Image.fromarray(pixels)
+        if i % 3 == 0:
+            # Un tercio en vertical, para ejercitar los recortes en ambas orientaciones
+            image = image.transpose(Image.Transpose.ROTATE_90)
+        if i % 10 == 9:
+            image.save(os.path.join(subfolder, f"photo_{i}.png"))
+        else:
+            image.save(os.path.join(subfolder, f"photo_{i}.jpg"), quality=90)
+
+
+def generate_base_image(path, size, seed):
+    """Crea una imagen base con degradados y formas de colores."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    x = np.linspace(0, 1, width)[None, :]
+    y = np.linspace(0, 1, height)[:, None]
+    pixels = np.stack([
+        255 * x * np.ones_like(y),
+        255 * y * np.ones_like(x),
+        127 + 127 * np.sin(6 * np.pi * x) * np.cos(4 * np.pi * y),
+    ], axis=-1)
+    for _ in range(20):
+        cx, cy, r = rng.random() * width, rng.random() * height, rng.random() * min(size) / 4
+        mask = (np.arange(width)[None, :] - cx) ** 2 + (np.arange(height)[:, None] - cy) ** 2 < r * r
+        pixels[mask] = rng.integers(0, 256, 3)
+    Image.fromarray(pixels.astype(np.uint8)).save(path)
+
+
+def run_stage(stages, name, items, unit, function, *args, **kwargs):
+    """Ejecuta una etapa, añade su medición a stages y devuelve su resultado."""
+    with PeakRssSampler() as sampler:
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    count = items(result) if callable(items) else items
+    stages.append({
+        "stage": name,
+        "seconds": round(seconds, 4),
+        "items": count,
+        "unit": unit,
+        "throughput": round(count / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(sampler.peak / 2 ** 20, 1),
+    })
+    print(f"{name:<22} {seconds:8.3f}s  {count / seconds if seconds else 0:10.1f} {unit}/s  "
+          f"pico RSS {sampler.peak / 2 ** 20:8.1f} MB")
+    return result
+
+
+def run_benchmark(args, workdir):
+    tiles_folder = os.path.join(workdir, "tiles")
+    processed_folder = os.path.join(workdir, "processed")
+    output_folder = os.path.join(workdir, "output")
+    base_image_path = os.path.join(workdir, "base.png")
+    shutil.rmtree(processed_folder, ignore_errors=True)
+    os.makedirs(processed_folder)
+    os.makedirs(output_folder, exist_ok=True)
+
+    dataset = {"tiles": args.tiles, "photo_size": list(args.photo_size), "seed": args.seed}
+    dataset_path = os.path.join(workdir, "dataset.json")
+    try:
+        with open(dataset_path, encoding="utf-8") as f:
+            reusable = json.load(f) == dataset
+    except (OSError, ValueError):
+        reusable = False
+    if not reusable:
+        print(f"Generando {args.tiles} fotos sintéticas de {args.photo_size[0]}x{args.photo_size[1]}...")
+        shutil.rmtree(tiles_folder, ignore_errors=True)
+        generate_tile_library(tiles_folder, args.tiles, args.photo_size, args.seed)
+        with open(dataset_path, "w", encoding="utf-8") as f:
+            json.dump(dataset, f)
+    generate_base_image(base_image_path, args.base_size, args.seed)
+
+    base_image = mosaic.correct_image_orientation(Image.open(base_image_path))
+    tile_size, grid_cols, grid_rows = mosaic.plan_grid(base_image.size, args.width, args.tiles, args.tile_size)
+    cells = grid_cols * grid_rows
+    mosaic_size = (grid_cols * tile_size[0], grid_rows * tile_size[1])
+    print(f"Teselas de {tile_size[0]}x{tile_size[1]}, grid {grid_cols}x{grid_rows}, "
+          f"mosaico de {mosaic_size[0]}x{mosaic_size[1]}")
+
+    stages = []
+    run_stage(stages, "process_tiles", args.tiles, "fotos",
+              mosaic.process_tiles, tile_size, args.workers, tiles_folder, processed_folder)
+    run_stage(stages, "process_tiles_cached", args.tiles, "fotos",
+              mosaic.process_tiles, tile_size, args.workers, tiles_folder, processed_folder)
+    tiles, tile_colors, tile_sizes = run_stage(
+        stages, "load_tiles", lambda result: len(result[0]), "teselas",
+        mosaic.load_tiles, tile_size, args.descriptor, processed_folder,
+    )
+    tiles, tile_colors = mosaic.filter_tiles_by_size(tiles, tile_colors, tile_sizes, tile_size)
+    tile_features, cell_features = run_stage(
+        stages, "cell_colors", cells, "celdas",
+        mosaic.color_features, base_image, tile_colors, grid_cols, grid_rows, tile_size, args.descriptor, args.lab,
+    )
+    assignment = run_stage(
+        stages, f"assign_{args.assign}", cells, "celdas",
+        mosaic.assign_tiles, cell_features, tile_features, args.assign, args.block_size,
+    )
+    assignment = assignment.reshape(grid_rows, grid_cols)
+    if (assignment < 0).any():
+        assignment, _ = run_stage(
+            stages, "schedule_repeats", int(np.count_nonzero(assignment < 0)), "celdas",
+            mosaic.schedule_repeats, assignment, cell_features, tile_features, args.max_uses, args.min_distance,
+        )
+    total_error = mosaic.assignment_error(cell_features, tile_features, assignment.ravel())
+
+    open_reused_tile = functools.lru_cache(maxsize=256)(mosaic.open_tile)
+    bands = mosaic.render_mosaic_bands(base_image, tiles, assignment, tile_size, 0.3, args.blend, open_reused_tile)
+    result = run_stage(stages, "composite", cells, "celdas", mosaic.assemble_in_memory, bands, mosaic_size)
+    megapixels = mosaic_size[0] * mosaic_size[1] / 1e6
+    run_stage(stages, "encode", megapixels, "Mpx",
+              mosaic.save_mosaic, result, os.path.join(output_folder, "mosaic_benchmark.jpg"))
+
+    return {
+        "config": {
+            "tiles": args.tiles,
+            "photo_size": list(args.photo_size),
+            "base_size": list(args.base_size),
+            "width": args.width,
+            "assign": args.assign,
+            "block_size": args.block_size,
+            "descriptor": args.descriptor,
+            "lab": args.lab,
+            "blend": args.blend,
+            "tile_size": args.tile_size,
+            "max_uses": args.max_uses,
+            "min_distance": args.min_distance,
+            "workers": args.workers or os.cpu_count(),
+            "seed": args.seed,
+        },
+        "mosaic": {
+            "tile_size": list(tile_size),
+            "grid": [grid_cols, grid_rows],
+            "size": list(mosaic_size),
+            "color_error_per_cell": round(total_error / max(1, np.count_nonzero(assignment >= 0)), 3),
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": stages,
+        "peak_rss_mb": round(peak_rss(resource.RUSAGE_SELF) / 2 ** 20, 1),
+        "peak_rss_children_mb": round(peak_rss(resource.RUSAGE_CHILDREN) / 2 ** 20, 1),
+    }
+
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de mosaic.py con datos sintéticos.")
+    parser.add_argument("--tiles", type=int, default=500, help="Número de fotos sintéticas")
+    parser.add_argument("--photo-size", type=parse_size, default=(1024, 768), help="Tamaño de las fotos, AxB")
+    parser.add_argument("--base-size", type=parse_size, default=(1600, 1200), help="Tamaño de la imagen base, AxB")
+    parser.add_argument("--width", type=int, default=4000, help="Ancho del mosaico")
+    parser.add_argument("--assign", choices=("greedy", "optimal", "blocked"), default="greedy")
+    parser.add_argument("--block-size", type=int, default=1024)
+    parser.add_argument("--descriptor", type=int, default=1)
+    parser.add_argument("--lab", action="store_true")
+    parser.add_argument("--blend", choices=("normal", "multiply", "soft-light"), default="normal")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Lado de las teselas; si es pequeño, hay más celdas que fotos y se repiten teselas")
+    parser.add_argument("--max-uses", type=int, default=None)
+    parser.add_argument("--min-distance", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None,
+                        help="Carpeta de trabajo; si se indica, la biblioteca sintética se reutiliza entre ejecuciones")
+    parser.add_argument("--report", default="benchmark_report.json", help="Archivo JSON con los resultados")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mosaic_benchmark_")
+    try:
+        report = run_benchmark(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Informe guardado en: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Medición compartida por mosaic.py, remove-duplicates.py y run_face_recognition.py.
+
+Metrics acumula el tiempo de cada etapa, contadores (archivos, bytes leídos, aciertos y
+fallos de caché...) y el pico de memoria, muestra el progreso como mucho una vez cada
+pocos segundos en lugar de una línea por archivo y, al terminar, imprime un resumen y
+guarda las métricas en JSON. Opcionalmente vuelca un perfil de cProfile.
+
+Ejemplo:
+    with Metrics("mosaic", metrics_path="metrics.json") as metrics:
+        with metrics.stage("process_tiles"):
+            for i, path in enumerate(paths, 1):
+                metrics.count("files")
+                metrics.count("bytes_read", os.path.getsize(path))
+                metrics.progress("Teselas", i, len(paths))
+"""
+
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+def current_rss():
+    """RSS actual del proceso en bytes (Linux; en otros sistemas, el pico hasta ahora)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss(resource.RUSAGE_SELF)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Pico de RSS en bytes del proceso o, con RUSAGE_CHILDREN, del mayor de sus hijos."""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRssSampler:
+    """Muestrea el RSS en un hilo aparte mientras dura el bloque with y guarda el máximo."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class Metrics:
+    """
+    Tiempos por etapa, contadores y progreso de una ejecución. Usado como bloque with,
+    además muestrea el pico de memoria, activa cProfile si se indica profile_path y al
+    salir imprime el resumen y lo guarda en metrics_path.
+    """
+
+    def __init__(self, name, metrics_path=None, profile_path=None, progress_interval=2.0, memory_interval=0.1):
+        self.name = name
+        self.metrics_path = metrics_path
+        self.profile_path = profile_path
+        self.progress_interval = progress_interval
+        self.stages = {}
+        self.counters = Counter()
+        self.sampler = PeakRssSampler(memory_interval)
+        self._profiler = None
+        self._start = time.perf_counter()
+        self._progress = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Suma al tiempo de la etapa name lo que dura el bloque with."""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        """Suma tiempo a una etapa; sirve para tiempos medidos en otros procesos."""
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def progress(self, label, done, total=None, force=False):
+        """
+        Muestra el progreso de label, como mucho una vez cada progress_interval segundos
+        (siempre con force o al llegar a total) y nunca dos veces con el mismo done. La
+        velocidad se mide desde la primera llamada con ese label.
+        """
+        now = time.perf_counter()
+        state = self._progress.setdefault(label, {"start": now, "shown_at": None, "shown": None})
+        if done == state["shown"]:
+            return
+        finished = total is not None and done >= total
+        recent = state["shown_at"] is not None and now - state["shown_at"] < self.progress_interval
+        if recent and not (force or finished):
+            return
+        state["shown_at"], state["shown"] = now, done
+        elapsed = now - state["start"]
+        rate = f", {done / elapsed:.1f}/s" if elapsed > 0 else ""
+        if total:
+            print(f"{label}: {done}/{total} ({done / total * 100:.1f}%){rate}", flush=True)
+        else:
+            print(f"{label}: {done}{rate}", flush=True)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def summary(self):
+        elapsed = self.elapsed()
+        return {
+            "name": self.name,
+            "command": sys.argv,
+            "seconds": round(elapsed, 3),
+            "stages": {
+                name: {"seconds": round(stage["seconds"], 3), "calls": stage["calls"]}
+                for name, stage in self.stages.items()
+            },
+            "counters": dict(self.counters),
+            "rates_per_second": {
+                name: round(value / elapsed, 2) for name, value in self.counters.items()
+            } if elapsed > 0 else {},
+            "peak_rss_mb": round(max(self.sampler.peak, current_rss()) / 2 ** 20, 1),
+            "peak_rss_children_mb": round(peak_rss(resource.RUSAGE_CHILDREN) / 2 ** 20, 1),
+        }
+
+    def report(self):
+        """Imprime las etapas de más lenta a más rápida, los contadores y la memoria."""
+        summary = self.summary()
+        total = summary["seconds"]
+        print(f"{self.name}: {total:.1f}s, pico RSS {summary['peak_rss_mb']} MB "
+              f"(procesos hijos {summary['peak_rss_children_mb']} MB)")
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            share = stage["seconds"] / total * 100 if total else 0
+            print(f"  {name:<24} {stage['seconds']:9.2f}s {share:6.1f}%  x{stage['calls']}")
+        for name, value in sorted(summary["counters"].items()):
+            print(f"  {name:<24} {value:>12}  ({summary['rates_per_second'].get(name, 0)}/s)")
+        return summary
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(temp_path, path)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self.sampler.__enter__()
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            print(f"Perfil de cProfile guardado en: {self.profile_path}")
+        self.sampler.__exit__(*exc)
+        self.report()
+        if self.metrics_path:
+            self.save(self.metrics_path)
+            print(f"Métricas guardadas en: {self.metrics_path}")
@@ -1,34 +1,42 @@
-from PIL import Image, ImageEnhance, ExifTags
-import pyheif
+from PIL import Image, ImageChops, ImageEnhance, ExifTags
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import os
 import numpy as np
 import time
 import gc
 import hashlib
 import random
-import sys
+import argparse
+import functools
+import json
+import shlex
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from instrumentation import Metrics
+from photo_catalog import catalog_file, scan_library
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None  # Solo necesario para los modos de asignación optimal y blocked
+
+try:
+    import pyheif
+except ImportError:
+    pyheif = None  # Solo necesario para las fotos HEIC cuando no está instalado pillow-heif
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    heif_opener = True
+except ImportError:
+    heif_opener = False  # Sin pillow-heif, las fotos HEIC se decodifican enteras con pyheif
 
 # Configuración
-base_image_path = sys.argv[1] if len(sys.argv) > 1 else 'path_to_base_image.png'  # Imagen principal
 tiles_folder = 'path_to_tiles'              # Carpeta con las fotos
 output_folder = 'output_mosaics'            # Carpeta para guardar mosaicos
 processed_tiles_folder = 'processed_tiles'  # Carpeta para guardar las teselas procesadas
-try:
-    desired_width = int(sys.argv[2]) if len(sys.argv) > 2 else 1920  # Tamaño
-except ValueError:
-    print("El valor proporcionado para desired_width no es válido. Usando el valor por defecto: 1920.")
-    desired_width = 1920
 valid_image_extensions = ('.jpg', '.jpeg', '.png', '.heic')  # Extensiones válidas
 
-# Opcional: Ajustar la opacidad de la imagen principal
-try:
-    overlay_opacity = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
-    if overlay_opacity < 0 or overlay_opacity > 1:
-        raise ValueError("La opacidad debe estar en el rango [0, 1].")
-except ValueError:
-    print("El valor proporcionado para overlay_opacity no es válido. Usando el valor por defecto: 0.3.")
-    overlay_opacity = 0.3   
-
 # Funciones auxiliares
 
 def correct_image_orientation(image):
@@ -58,9 +66,19 @@ def calculate_tile_size(total_images, final_width, aspect_ratio):
         tile_width = tile_height = max(100, int(np.sqrt((final_width * final_height) / (0.8 * total_images))))
     return tile_width, tile_height
 
-# Crear carpetas de salida si no existen
-os.makedirs(output_folder, exist_ok=True)
-os.makedirs(processed_tiles_folder, exist_ok=True)
+def plan_grid(base_size, desired_width, total_images, tile_side=None):
+    """
+    Tamaño de tesela y número de columnas y filas del grid para el ancho deseado. Sin
+    tile_side, el tamaño se elige para que haya algo menos de celdas que fotos.
+    """
+    base_width, base_height = base_size
+    aspect_ratio = base_width / base_height
+    final_height = int(desired_width / aspect_ratio)
+    if tile_side:
+        tile_width = tile_height = tile_side
+    else:
+        tile_width, tile_height = calculate_tile_size(total_images, desired_width, aspect_ratio)
+    return (tile_width, tile_height), desired_width // tile_width, final_height // tile_height
 
 # Funciones para trabajar con colores
 
@@ -69,7 +87,10 @@ def average_color(image):
     w, h, d = img.shape
     return tuple(np.mean(img.reshape(w * h, d), axis=0))
 
-def convert_heic_to_png(heic_path, output_path):
+def open_heic(heic_path):
+    """Decodifica una foto HEIC con pyheif. libheif ya aplica la rotación de la foto."""
+    if pyheif is None:
+        raise ImportError("Para leer fotos HEIC hace falta pillow-heif o pyheif")
     heif_file = pyheif.read(heic_path)
     image = Image.frombytes(
         heif_file.mode, 
@@ -79,74 +100,550 @@ def convert_heic_to_png(heic_path, output_path):
         heif_file.mode,
         heif_file.stride,
     )
-    image.save(output_path, format="PNG")
+    return image
+
+def color_distances(cell_colors, tile_colors):
+    """Distancias euclídeas al cuadrado entre cada color de celda y cada color de tesela."""
+    if cell_colors.shape[1] > 3:
+        # Con descriptores largos compensa la forma |a|² + |b|² - 2ab, resuelta como producto de matrices
+        distances = cell_colors @ tile_colors.T
+        distances *= -2
+        distances += (cell_colors * cell_colors).sum(axis=1)[:, None]
+        distances += (tile_colors * tile_colors).sum(axis=1)[None, :]
+        return np.maximum(distances, 0, out=distances)
+    distances = np.zeros((len(cell_colors), len(tile_colors)))
+    for channel in range(cell_colors.shape[1]):
+        diff = cell_colors[:, channel, None] - tile_colors[None, :, channel]
+        distances += diff * diff
+    return distances
+
+def match_tiles_greedy(cell_colors, tile_colors, candidates=16):
+    """
+    Asigna a cada celda, en orden, la tesela libre de color más cercano sin repetir teselas.
+    Devuelve un array con el índice de tesela de cada celda, o -1 si ya no quedan teselas libres.
+    """
+    cell_colors = np.ascontiguousarray(cell_colors, dtype=np.float64)
+    tile_colors = np.ascontiguousarray(tile_colors, dtype=np.float64)
+    total_cells, total_tiles = len(cell_colors), len(tile_colors)
+    assignment = np.full(total_cells, -1, dtype=np.int64)
+    used = np.zeros(total_tiles, dtype=bool)
+    used_count = 0
+    k = min(candidates, total_tiles)
+    # Procesar las celdas por bloques para acotar la memoria de la matriz de distancias
+    chunk = max(1, (1 << 20) // max(total_tiles, 1))
+
+    for start in range(0, total_cells, chunk):
+        if used_count == total_tiles:
+            break
+        distances = color_distances(cell_colors[start:start + chunk], tile_colors)
+        if k < total_tiles:
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(total_tiles), distances.shape)
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        # Ordenar los candidatos por distancia y, a igual distancia, por índice
+        order = np.lexsort((nearest, nearest_distances))
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+        limits = nearest_distances[:, -1]
+
+        for i in range(len(distances)):
+            if used_count == total_tiles:
+                break
+            free = np.flatnonzero(~used[nearest[i]])
+            if len(free) and (k == total_tiles or nearest_distances[i, free[0]] < limits[i]):
+                idx = nearest[i, free[0]]
+            else:
+                # Candidatos agotados o empatados con teselas fuera de la lista: búsqueda exacta
+                idx = np.argmin(np.where(used, np.inf, distances[i]))
+            used[idx] = True
+            used_count += 1
+            assignment[start + i] = idx
+
+    return assignment
+
+def match_tiles_optimal(cell_colors, tile_colors):
+    """
+    Resuelve la asignación celda-tesela como un problema de asignación lineal que minimiza
+    el error de color total. Necesita la matriz completa de distancias (celdas x teselas).
+    """
+    cell_colors = np.ascontiguousarray(cell_colors, dtype=np.float64)
+    tile_colors = np.ascontiguousarray(tile_colors, dtype=np.float64)
+    assignment = np.full(len(cell_colors), -1, dtype=np.int64)
+    cost = np.sqrt(color_distances(cell_colors, tile_colors))
+    rows, cols = linear_sum_assignment(cost)
+    assignment[rows] = cols
+    return assignment
+
+def match_tiles_blocked(cell_colors, tile_colors, block_size=1024, candidates=8):
+    """
+    Variante aproximada de la asignación óptima con memoria acotada: resuelve la asignación
+    por bloques de celdas repartidas por toda la imagen, limitando cada bloque a las teselas
+    libres más cercanas a sus celdas.
+    """
+    cell_colors = np.ascontiguousarray(cell_colors, dtype=np.float64)
+    tile_colors = np.ascontiguousarray(tile_colors, dtype=np.float64)
+    total_cells, total_tiles = len(cell_colors), len(tile_colors)
+    assignment = np.full(total_cells, -1, dtype=np.int64)
+    free_tiles = np.arange(total_tiles)
+    # Bloques intercalados (celda i -> bloque i % n) para que las mejores teselas
+    # no se agoten en las primeras filas
+    total_blocks = -(-total_cells // block_size)
+
+    for block in range(total_blocks):
+        if len(free_tiles) == 0:
+            break
+        cells = np.arange(block, total_cells, total_blocks)
+        distances = color_distances(cell_colors[cells], tile_colors[free_tiles])
+        k = min(candidates, len(free_tiles))
+        if len(cells) * k < len(free_tiles):
+            nearest = np.unique(np.argpartition(distances, k - 1, axis=1)[:, :k])
+            if len(nearest) < len(cells):
+                # Completar con las teselas libres más cercanas al bloque en conjunto
+                others = np.setdiff1d(np.arange(len(free_tiles)), nearest)
+                closest = others[np.argsort(distances[:, others].min(axis=0))[:len(cells) - len(nearest)]]
+                nearest = np.concatenate((nearest, closest))
+            distances = distances[:, nearest]
+        else:
+            nearest = np.arange(len(free_tiles))
+        rows, cols = linear_sum_assignment(np.sqrt(distances))
+        chosen = free_tiles[nearest[cols]]
+        assignment[cells[rows]] = chosen
+        free_tiles = np.setdiff1d(free_tiles, chosen, assume_unique=True)
+
+    return assignment
+
+def assign_tiles(cell_colors, tile_colors, strategy, block_size=1024):
+    """Asigna teselas a celdas con la estrategia indicada (greedy, optimal o blocked)."""
+    if strategy == "optimal":
+        return match_tiles_optimal(cell_colors, tile_colors)
+    if strategy == "blocked":
+        return match_tiles_blocked(cell_colors, tile_colors, block_size)
+    return match_tiles_greedy(cell_colors, tile_colors)
+
+def assignment_error(cell_colors, tile_colors, assignment):
+    """Error de color total (suma de distancias euclídeas) de las celdas con tesela asignada."""
+    assigned = assignment >= 0
+    diff = np.asarray(cell_colors)[assigned] - np.asarray(tile_colors)[assignment[assigned]]
+    return float(np.sqrt((diff * diff).sum(axis=1)).sum())
+
+def schedule_repeats(assignment, cell_colors, tile_colors, max_uses=None, min_distance=3):
+    """
+    Completa las celdas sin tesela (-1) de una asignación (filas x columnas) repitiendo
+    teselas: cada tesela se usa como mucho max_uses veces en total (por defecto, las justas
+    para cubrir el grid) y dos usos de la misma tesela quedan al menos a min_distance celdas
+    (en filas o columnas). Las celdas se recorren en rondas de celdas separadas min_distance
+    entre sí, que no pueden interferir, y cada ronda se resuelve a la vez: la distancia de
+    color se penaliza con infinito para las teselas agotadas o presentes en la vecindad de
+    la celda. Si dos celdas de la ronda eligen una tesela con un solo uso libre, se la queda
+    la más parecida y la otra vuelve a elegir.
+    Devuelve la asignación completa y el número de celdas en las que no se pudo respetar la
+    distancia mínima o el límite de usos.
+    """
+    grid_rows, grid_cols = assignment.shape
+    total_tiles = len(tile_colors)
+    if total_tiles == 0 or (assignment >= 0).all():
+        return assignment, 0
+    # Aquí se calculan celdas x teselas distancias para todas las celdas por completar, así
+    # que se usa la forma |a|² + |b|² - 2ab en float32, varias veces más rápida
+    cell_colors = np.ascontiguousarray(cell_colors, dtype=np.float32)
+    tile_colors = np.ascontiguousarray(tile_colors, dtype=np.float32)
+    tile_norms = (tile_colors * tile_colors).sum(axis=1)
+
+    def distances_to_tiles(cells):
+        colors = cell_colors[cells]
+        distances = colors @ tile_colors.T
+        distances *= -2
+        distances += (colors * colors).sum(axis=1)[:, None]
+        distances += tile_norms
+        return distances
+
+    if max_uses is None:
+        max_uses = -(-assignment.size // total_tiles)
+    radius = max(0, min_distance - 1)
+    spacing = max(1, min_distance)
+    uses = np.bincount(assignment[assignment >= 0], minlength=total_tiles)
+    # Grid con un borde de -1 para tomar la vecindad de cada celda como una ventana
+    padded = np.pad(assignment, radius, constant_values=-1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (2 * radius + 1, 2 * radius + 1))
+    relaxed = 0
+    chunk = max(1, (1 << 20) // total_tiles)
+
+    for row_offset in range(spacing):
+        for col_offset in range(spacing):
+            rows, cols = np.nonzero(padded[radius + row_offset:radius + grid_rows:spacing,
+                                           radius + col_offset:radius + grid_cols:spacing] < 0)
+            rows = rows * spacing + row_offset
+            cols = cols * spacing + col_offset
+            for start in range(0, len(rows), chunk):
+                wave_rows, wave_cols = rows[start:start + chunk], cols[start:start + chunk]
+                cost = distances_to_tiles(wave_rows * grid_cols + wave_cols)
+                # Teselas ya usadas cerca de cada celda (la columna extra recoge las celdas vacías)
+                nearby = np.zeros((len(wave_rows), total_tiles + 1), dtype=bool)
+                neighbours = windows[wave_rows, wave_cols].reshape(len(wave_rows), -1)
+                nearby[np.arange(len(wave_rows))[:, None], neighbours] = True
+                cost[nearby[:, :total_tiles]] = np.inf
+                pending = np.arange(len(wave_rows))
+                while len(pending):
+                    candidate_cost = cost[pending]
+                    candidate_cost[:, uses >= max_uses] = np.inf
+                    choice = np.argmin(candidate_cost, axis=1)
+                    feasible = np.isfinite(candidate_cost[np.arange(len(pending)), choice])
+                    if not feasible.all():
+                        # Sin teselas posibles: se relaja la distancia y, si hace falta, el límite de usos
+                        stuck = pending[~feasible]
+                        distances = distances_to_tiles(wave_rows[stuck] * grid_cols + wave_cols[stuck])
+                        # De una en una, para que cada celda vea los usos que dejan libres las anteriores
+                        for cell, distance in zip(stuck, distances):
+                            if (uses < max_uses).any():
+                                distance[uses >= max_uses] = np.inf
+                            tile = np.argmin(distance)
+                            padded[wave_rows[cell] + radius, wave_cols[cell] + radius] = tile
+                            uses[tile] += 1
+                        relaxed += len(stuck)
+                        pending, choice = pending[feasible], choice[feasible]
+                        candidate_cost = candidate_cost[feasible]
+                        if len(pending) == 0:
+                            break
+                    # Con varios candidatos a la misma tesela, solo entran los usos que le quedan
+                    picked_cost = candidate_cost[np.arange(len(pending)), choice]
+                    order = np.lexsort((picked_cost, choice))
+                    sorted_choice = choice[order]
+                    first = np.r_[True, sorted_choice[1:] != sorted_choice[:-1]]
+                    group_start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+                    rank = np.arange(len(order)) - group_start
+                    accepted = order[rank < (max_uses - uses[sorted_choice])]
+                    tiles = choice[accepted]
+                    padded[wave_rows[pending[accepted]] + radius, wave_cols[pending[accepted]] + radius] = tiles
+                    np.add.at(uses, tiles, 1)
+                    pending = np.setdiff1d(pending, pending[accepted], assume_unique=True)
+
+    return padded[radius:radius + grid_rows, radius:radius + grid_cols].copy(), relaxed
+
+# Modos de fusión de la imagen principal con el mosaico (sobre imágenes RGB)
+blend_modes = {
+    "multiply": ImageChops.multiply,
+    "soft-light": ImageChops.soft_light,
+}
+
+def apply_overlay(mosaic, overlay, opacity, blend_mode="normal", strip_height=512):
+    """
+    Compone la imagen principal sobre el mosaico con la opacidad indicada. Trabaja por
+    franjas horizontales y modifica el mosaico en el sitio para no duplicar la memoria.
+    """
+    alpha_table = [int(a * opacity) for a in range(256)]
+    for top in range(0, mosaic.height, strip_height):
+        box = (0, top, mosaic.width, min(top + strip_height, mosaic.height))
+        strip = mosaic.crop(box)
+        overlay_strip = overlay.crop(box)
+        alpha = overlay_strip.getchannel('A').point(alpha_table)
+        if blend_mode in blend_modes:
+            layer = blend_modes[blend_mode](strip.convert('RGB'), overlay_strip.convert('RGB'))
+        else:
+            layer = overlay_strip.convert('RGB')
+        layer.putalpha(alpha)
+        mosaic.paste(Image.alpha_composite(strip, layer), box[:2])
+    return mosaic
+
+def open_tile(path):
+    """Decodifica una tesela procesada como RGBA."""
+    with Image.open(path) as tile_image:
+        return tile_image.convert('RGBA')
+
+def base_band(base_image, size, top, bottom):
+    """Franja [top, bottom) de la imagen principal escalada a size, sin escalar la imagen entera."""
+    scale = base_image.height / size[1]
+    box = (0, top * scale, base_image.width, bottom * scale)
+    return base_image.resize((size[0], bottom - top), box=box).convert('RGBA')
+
+def block_means(pixels, grid, axis_offset=0):
+    """
+    Medias de los grid x grid bloques de un array de píxeles (alto, ancho, canales). Con
+    axis_offset=1 el array es (alto, celdas, ancho, canales) y se calculan por celda.
+    """
+    rows = np.linspace(0, pixels.shape[0], grid + 1).astype(int)
+    cols = np.linspace(0, pixels.shape[1 + axis_offset], grid + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(pixels, rows[:-1], axis=0, dtype=np.float64), cols[:-1], axis=1 + axis_offset)
+    counts = np.outer(np.diff(rows), np.diff(cols))
+    if axis_offset:
+        counts = counts[:, None, :]
+    return sums / counts[..., None]
+
+def color_descriptor(image, grid):
+    """Descriptor de color de una tesela: las medias RGB de grid x grid bloques."""
+    return block_means(np.asarray(image.convert('RGB')), grid)
+
+def cell_colors_by_band(base_image, grid_cols, grid_rows, tile_size, grid=1):
+    """
+    Color medio de grid x grid bloques de cada celda del grid del mosaico, con forma
+    (filas, columnas, grid, grid, 4). Se calcula fila a fila para no escalar la imagen entera.
+    """
+    tile_width, tile_height = tile_size
+    size = (grid_cols * tile_width, grid_rows * tile_height)
+    colors = np.empty((grid_rows, grid_cols, grid, grid, 4))
+    for y in range(grid_rows):
+        band = np.asarray(base_band(base_image, size, y * tile_height, (y + 1) * tile_height))
+        cells = band.reshape(tile_height, grid_cols, tile_width, 4)
+        colors[y] = block_means(cells, grid, axis_offset=1).transpose(1, 0, 2, 3)
+    return colors
+
+def rgb_to_lab(rgb):
+    """Convierte colores sRGB (0-255, último eje de tamaño 3) a CIELAB con iluminante D65."""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ np.array([
+        [0.4124564, 0.2126729, 0.0193339],
+        [0.3575761, 0.7151522, 0.1191920],
+        [0.1804375, 0.0721750, 0.9503041],
+    ])
+    xyz /= (0.95047, 1.0, 1.08883)
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack((116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])), axis=-1)
+
+# Índice persistente de teselas
+
+def tile_index_path(tile_size, processed_tiles_folder=processed_tiles_folder):
+    return os.path.join(processed_tiles_folder, f"index_{tile_size[0]}x{tile_size[1]}.npz")
+
+def tile_index_entry(source="", source_size=-1, source_mtime=-1.0, color=None, size=(0, 0), descriptors=None):
+    """
+    Entrada del índice. Un color None indica que aún hay que calcularlo a partir de la tesela.
+    descriptors asocia cada tamaño de grid con el descriptor de color (color_descriptor) ya calculado.
+    """
+    return {
+        "source": source,
+        "source_size": source_size,
+        "source_mtime": source_mtime,
+        "color": color,
+        "size": tuple(size),
+        "descriptors": descriptors or {},
+    }
+
+def load_tile_index(tile_size, processed_tiles_folder=processed_tiles_folder):
+    """
+    Carga el índice de teselas de una resolución: un diccionario que asocia el nombre de
+    cada tesela (generate_hashed_filename) con su foto original, el tamaño y la fecha de
+    modificación de esta, el color medio, el tamaño de la tesela y sus descriptores de color.
+    """
+    path = tile_index_path(tile_size, processed_tiles_folder)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as data:
+            index = {
+                name: tile_index_entry(
+                    str(source), int(source_size), float(source_mtime),
+                    None if np.isnan(color).any() else tuple(color), size
+                )
+                for name, source, source_size, source_mtime, color, size in zip(
+                    data["names"], data["sources"], data["source_sizes"], data["source_mtimes"],
+                    data["colors"], data["sizes"].tolist()
+                )
+            }
+            for key in data.files:
+                if key.startswith("descriptors_"):
+                    grid = int(key[len("descriptors_"):])
+                    for name, descriptor in zip(data["names"], data[key]):
+                        if not np.isnan(descriptor).any():
+                            index[name]["descriptors"][grid] = descriptor
+            return index
+    except Exception as e:
+        print(f"No se pudo leer el índice de teselas {path}: {e}")
+        return {}
+
+def save_tile_index(tile_size, index, processed_tiles_folder=processed_tiles_folder):
+    path = tile_index_path(tile_size, processed_tiles_folder)
+    names = sorted(index)
+    entries = [index[name] for name in names]
+    temp_path = path + ".tmp.npz"
+    descriptors = {}
+    for grid in sorted({grid for entry in entries for grid in entry["descriptors"]}):
+        missing = np.full((grid, grid, 3), np.nan)
+        descriptors[f"descriptors_{grid}"] = np.array(
+            [entry["descriptors"].get(grid, missing) for entry in entries], dtype=np.float64
+        ).reshape(-1, grid, grid, 3)
+    np.savez(
+        temp_path,
+        names=np.array(names, dtype=str),
+        sources=np.array([entry["source"] for entry in entries], dtype=str),
+        source_sizes=np.array([entry["source_size"] for entry in entries], dtype=np.int64),
+        source_mtimes=np.array([entry["source_mtime"] for entry in entries], dtype=np.float64),
+        colors=np.array([entry["color"] or (np.nan,) * 4 for entry in entries], dtype=np.float64).reshape(-1, 4),
+        sizes=np.array([entry["size"] for entry in entries], dtype=np.int64).reshape(-1, 2),
+        **descriptors,
+    )
+    os.replace(temp_path, path)
 
 def generate_hashed_filename(filepath, resolution):
     md5_hash = hashlib.md5(filepath.encode()).hexdigest()
     return f"{md5_hash}_{resolution[0]}x{resolution[1]}.jpg"
 
-def process_tiles(tile_size):
-    total_files = sum([len(files) for _, _, files in os.walk(tiles_folder)])
+def crop_and_resize_tile(img, tile_size):
+    """Recorta el centro de la imagen a la proporción de la tesela y la reduce a tile_size."""
+    img_width, img_height = img.size
+    target_ratio = tile_size[0] / tile_size[1]
+    img_ratio = img_width / img_height
+
+    if img_ratio > target_ratio:
+        new_width = int(target_ratio * img_height)
+        offset = (img_width - new_width) // 2
+        box = (offset, 0, offset + new_width, img_height)
+    else:
+        new_height = int(img_width / target_ratio)
+        offset = (img_height - new_height) // 2
+        box = (0, offset, img_width, offset + new_height)
+
+    # reducing_gap aplica primero una reducción entera (Image.reduce), mucho más barata
+    return img.resize(tile_size, box=box, reducing_gap=3.0)
+
+def render_tile(img_path, tile_size):
+    """Recorta y reduce una foto a tile_size, con la orientación corregida."""
+    if img_path.lower().endswith('.heic') and not heif_opener:
+        return crop_and_resize_tile(open_heic(img_path).convert('RGB'), tile_size)
+
+    img = Image.open(img_path)
+    if img.format in ('JPEG', 'HEIF'):
+        # Decodificar directamente a una escala reducida (1/2, 1/4 o 1/8 en JPEG, la miniatura
+        # incluida en HEIC) que siga cubriendo la tesela, sea cual sea la orientación EXIF
+        scale = max(tile_size) / min(img.size)
+        img.draft('RGB', (int(np.ceil(img.width * scale)), int(np.ceil(img.height * scale))))
+    if img.format != 'HEIF':
+        img = correct_image_orientation(img)
+    return crop_and_resize_tile(img.convert('RGB'), tile_size)
+
+def process_tile(img_path, output_path, tile_size):
+    """
+    Genera la tesela de una foto. Se ejecuta en los procesos del pool de process_tiles.
+    Devuelve el color medio y el tamaño de la tesela para el índice.
+    """
+    img = render_tile(img_path, tile_size)
+    img.save(output_path, format="JPEG", quality=90)
+    return average_color(img.convert('RGBA')), img.size
+
+def process_tiles(tile_size, workers=None, tiles_folder=tiles_folder, processed_tiles_folder=processed_tiles_folder,
+                  metrics=None, files=None):
+    """
+    Genera en paralelo las teselas de tile_size que faltan o cuyas fotos han cambiado.
+    files es el recorrido de tiles_folder hecho con photo_catalog.scan_library; si no se
+    indica, la carpeta se recorre aquí sin guardar catálogo.
+    """
+    metrics = metrics or Metrics("process_tiles")
+    if files is None:
+        files = scan_library([tiles_folder], None, metrics=metrics)
+    total_files = sum(img_path.lower().endswith(valid_image_extensions) for _, img_path, _ in files)
+    workers = workers or os.cpu_count() or 1
+    index = load_tile_index(tile_size, processed_tiles_folder)
     processed_count = 0
-    for root, _, files in os.walk(tiles_folder):
-        for file in files:
-            img_path = os.path.join(root, file)
-            if not file.lower().endswith(valid_image_extensions):
-                print(f"Archivo no compatible ignorado: {img_path}")
+
+    def report_progress(force=False):
+        metrics.progress("Teselas procesadas", processed_count, total_files, force)
+
+    def pending_tiles():
+        for _, img_path, photo in files:
+            if not img_path.lower().endswith(valid_image_extensions):
+                metrics.count("unsupported_files")
                 continue
-            try:
-                hashed_filename = generate_hashed_filename(img_path, tile_size)
-                output_path = os.path.join(processed_tiles_folder, hashed_filename)
+            hashed_filename = generate_hashed_filename(img_path, tile_size)
+            output_path = os.path.join(processed_tiles_folder, hashed_filename)
+            yield img_path, output_path, photo
+
+    def collect(future, img_path, output_path, photo):
+        nonlocal processed_count
+        try:
+            color, size = future.result()
+            index[os.path.basename(output_path)] = tile_index_entry(
+                img_path, photo["size"], photo["mtime"], color, size
+            )
+            processed_count += 1
+            metrics.count("tiles_rendered")
+            metrics.count("bytes_read", photo["size"])
+            report_progress()
+        except Exception as e:
+            print(f"Error al procesar {img_path}: {e}")
+            metrics.count("errors")
 
-                if os.path.exists(output_path):
-                    print(f"Tesela ya procesada: {output_path}")
+    with metrics.stage("process_tiles"), ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        # Limitar el trabajo en curso para no encolar toda la biblioteca de golpe
+        max_in_flight = workers * 4
+        for img_path, output_path, photo in pending_tiles():
+            hashed_filename = os.path.basename(output_path)
+            entry = index.get(hashed_filename)
+            if os.path.exists(output_path):
+                if entry is None:
+                    # Tesela generada antes de existir el índice: su color se calcula en load_tiles
+                    entry = index[hashed_filename] = tile_index_entry(img_path, photo["size"], photo["mtime"])
+                if entry["source_size"] == photo["size"] and entry["source_mtime"] == photo["mtime"]:
+                    metrics.count("tile_cache_hits")
                     processed_count += 1
-                    print(f"Progreso: {processed_count}/{total_files} teselas procesadas ({(processed_count / total_files) * 100:.2f}%)")
+                    report_progress()
                     continue
+                print(f"La foto ha cambiado, se vuelve a procesar: {img_path}")
 
-                if file.lower().endswith('.heic'):
-                    convert_heic_to_png(img_path, output_path)
-                else:
-                    img = Image.open(img_path)
-                    img = correct_image_orientation(img).convert('RGB')
-
-                    img_width, img_height = img.size
-                    target_ratio = tile_size[0] / tile_size[1]
-                    img_ratio = img_width / img_height
-
-                    if img_ratio > target_ratio:
-                        new_width = int(target_ratio * img_height)
-                        offset = (img_width - new_width) // 2
-                        img = img.crop((offset, 0, offset + new_width, img_height))
-                    else:
-                        new_height = int(img_width / target_ratio)
-                        offset = (img_height - new_height) // 2
-                        img = img.crop((0, offset, img_width, offset + new_height))
-
-                    img = img.resize(tile_size)
-                    img.save(output_path, format="JPEG", quality=90)
-
-                processed_count += 1
-                print(f"Progreso: {processed_count}/{total_files} teselas procesadas ({(processed_count / total_files) * 100:.2f}%)")
-            except Exception as e:
-                print(f"Error al procesar {img_path}: {e}")
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, *in_flight.pop(future))
+
+            metrics.count("tile_cache_misses")
+            future = executor.submit(process_tile, img_path, output_path, tile_size)
+            in_flight[future] = (img_path, output_path, photo)
+
+        for future in list(in_flight):
+            collect(future, *in_flight.pop(future))
+
+    report_progress(force=True)
+    if len(files) > total_files:
+        print(f"Archivos no compatibles ignorados: {len(files) - total_files}")
+    save_tile_index(tile_size, index, processed_tiles_folder)
 
 
-def load_tiles(tile_size):
+def load_tiles(tile_size, descriptor_grid=1, processed_tiles_folder=processed_tiles_folder):
+    """
+    Devuelve las rutas, los colores medios y los tamaños de las teselas de una resolución.
+    Con descriptor_grid > 1, en lugar del color medio se devuelve el descriptor de color de
+    descriptor_grid x descriptor_grid bloques. Los colores y descriptores salen del índice
+    persistente; solo se decodifican las teselas para las que aún no se han calculado.
+    """
+    index = load_tile_index(tile_size, processed_tiles_folder)
     tiles = []
     tile_colors = []
+    tile_sizes = []
+    found = set()
+    index_changed = False
     resolution_suffix = f"_{tile_size[0]}x{tile_size[1]}.jpg"
     for root, _, files in os.walk(processed_tiles_folder):
         for file in files:
             if not file.endswith(resolution_suffix):
                 continue
             img_path = os.path.join(root, file)
-            try:
-                img = Image.open(img_path).convert('RGBA')
-                tiles.append(img)
-                tile_colors.append(average_color(img))
-            except Exception as e:
-                print(f"Error al cargar {img_path}: {e}")
+            entry = index.get(file)
+            if entry is None or entry["color"] is None or (
+                descriptor_grid > 1 and descriptor_grid not in entry["descriptors"]
+            ):
+                try:
+                    with Image.open(img_path) as img:
+                        img = img.convert('RGBA')
+                    entry = index[file] = entry or tile_index_entry()
+                    entry["color"] = average_color(img)
+                    entry["size"] = img.size
+                    if descriptor_grid > 1:
+                        entry["descriptors"][descriptor_grid] = color_descriptor(img, descriptor_grid)
+                    index_changed = True
+                except Exception as e:
+                    print(f"Error al cargar {img_path}: {e}")
+                    continue
+            found.add(file)
+            tiles.append(img_path)
+            tile_colors.append(entry["descriptors"][descriptor_grid] if descriptor_grid > 1 else entry["color"])
+            tile_sizes.append(entry["size"])
+
+    # Olvidar las teselas que ya no existen en disco
+    for name in set(index) - found:
+        del index[name]
+        index_changed = True
+    if index_changed:
+        save_tile_index(tile_size, index, processed_tiles_folder)
     
     # Crear una lista de índices y mezclarla aleatoriamente
     indices = list(range(len(tiles)))
@@ -155,86 +652,579 @@ def load_tiles(tile_size):
     # Reorganizar las listas de acuerdo con el orden aleatorio
     tiles = [tiles[i] for i in indices]
     tile_colors = [tile_colors[i] for i in indices]
+    tile_sizes = [tile_sizes[i] for i in indices]
     
-    return tiles, tile_colors
-
-base_image = Image.open(base_image_path)
-base_image = correct_image_orientation(base_image)
-base_width, base_height = base_image.size
-aspect_ratio = base_width / base_height
-final_width = desired_width
-final_height = int(final_width / aspect_ratio)
-total_images = sum([len(files) for _, _, files in os.walk(tiles_folder)])
-tile_width, tile_height = calculate_tile_size(total_images, final_width, aspect_ratio)
-grid_cols = final_width // tile_width
-grid_rows = final_height // tile_height
-tile_size = (tile_width, tile_height)
-
-print(f"Tamaño de cada tesela: {tile_size}")
-print(f"Grid: {grid_cols}x{grid_rows} ({grid_cols * grid_rows} teselas)")
-print("Procesando teselas...")
-process_tiles(tile_size)
-tiles, tile_colors = load_tiles(tile_size)
-total_tiles = len(tiles)
-if total_tiles == 0:
-    raise ValueError("No se encontraron imágenes válidas en la carpeta especificada.")
-
-print(f"Fotos disponibles: {total_tiles}")
-new_width = grid_cols * tile_width
-new_height = grid_rows * tile_height
-base_image = base_image.resize((new_width, new_height)).convert('RGBA')
-base_pixels = np.array(base_image).reshape((grid_rows, tile_height, grid_cols, tile_width, 4)).mean(axis=(1, 3))
-filtered_tiles = []
-filtered_colors = []
-for i, tile in enumerate(tiles):
-    if tile.size == tile_size:
-        filtered_tiles.append(tile)
-        filtered_colors.append(tile_colors[i])
-tiles = filtered_tiles
-tile_colors = filtered_colors
-if len(tiles) == 0:
-    raise ValueError("No hay teselas que coincidan con la resolución esperada.")
-
-mosaic = Image.new('RGBA', base_image.size)
-used_tiles = set()
-
-for y in range(grid_rows):
-    row = Image.new('RGBA', (new_width, tile_height))
-    for x in range(grid_cols):
-        base_color = tuple(base_pixels[y, x][:3])
-        closest_tile_idx = None
-        min_distance = float('inf')
-        for idx, tile_color in enumerate(tile_colors):
-            if idx in used_tiles:
+    return tiles, tile_colors, tile_sizes
+
+def filter_tiles_by_size(tiles, tile_colors, tile_sizes, tile_size):
+    """Descarta las teselas cuya resolución no coincide con tile_size."""
+    filtered_tiles = []
+    filtered_colors = []
+    for i, tile in enumerate(tiles):
+        if tile_sizes[i] == tile_size:
+            filtered_tiles.append(tile)
+            filtered_colors.append(tile_colors[i])
+    return filtered_tiles, filtered_colors
+
+def color_features(base_image, tile_colors, grid_cols, grid_rows, tile_size, descriptor_grid=1, lab=False):
+    """
+    Vectores de color de las teselas y de las celdas del grid, listos para assign_tiles:
+    3 valores (RGB o Lab) por cada bloque del descriptor.
+    """
+    base_pixels = cell_colors_by_band(base_image, grid_cols, grid_rows, tile_size, descriptor_grid)
+    tile_colors = np.array(tile_colors)[..., :3]
+    cell_colors = base_pixels[..., :3]
+    if lab:
+        tile_colors = rgb_to_lab(tile_colors)
+        cell_colors = rgb_to_lab(cell_colors)
+    return tile_colors.reshape(len(tile_colors), -1), cell_colors.reshape(grid_rows * grid_cols, -1)
+
+# Ensamblado y guardado del mosaico
+
+# Tamaño máximo (en píxeles por lado) que admiten los formatos de salida
+jpeg_max_size = 65535
+webp_max_size = 16383
+
+def render_mosaic_bands(base_image, tiles, assignment, tile_size, opacity, blend_mode, open_reused_tile):
+    """
+    Genera el mosaico fila a fila: para cada fila de teselas devuelve (y, franja RGB) con la
+    imagen principal ya superpuesta, de modo que nunca hay más de una franja en memoria.
+    Las teselas que se repiten (schedule_repeats) se abren con open_reused_tile, que las
+    guarda en caché; las celdas sin tesela (-1) quedan vacías.
+    """
+    grid_rows, grid_cols = assignment.shape
+    tile_width, tile_height = tile_size
+    size = (grid_cols * tile_width, grid_rows * tile_height)
+    reused = np.bincount(assignment[assignment >= 0], minlength=len(tiles)) > 1
+    for y in range(grid_rows):
+        row = Image.new('RGBA', (size[0], tile_height))
+        for x in range(grid_cols):
+            closest_tile_idx = assignment[y, x]
+            if closest_tile_idx < 0:
                 continue
-            distance = np.linalg.norm(np.array(tile_color[:3]) - np.array(base_color))
-            if distance < min_distance:
-                min_distance = distance
-                closest_tile_idx = idx
-
-        if closest_tile_idx is None or closest_tile_idx >= len(tiles):
-            print(f"No se encontró una tesela adecuada para la posición ({y}, {x}). Usando una tesela aleatoria.")
-            closest_tile = random.choice(tiles)
+            if reused[closest_tile_idx]:
+                tile_image = open_reused_tile(tiles[closest_tile_idx])
+            else:
+                tile_image = open_tile(tiles[closest_tile_idx])
+
+            row.paste(tile_image, (x * tile_width, 0))
+        top = y * tile_height
+        apply_overlay(row, base_band(base_image, size, top, top + tile_height), opacity, blend_mode)
+        yield top, row.convert('RGB')
+
+def assemble_in_memory(bands, size):
+    mosaic = Image.new('RGB', size)
+    for top, band in bands:
+        mosaic.paste(band, (0, top))
+    return mosaic
+
+def assemble_to_memmap(bands, size, raw_path):
+    """
+    Escribe las franjas en un buffer RGBX mapeado en disco. Devuelve una imagen que comparte
+    ese buffer, para codificarla después sin cargar el mosaico entero en memoria.
+    """
+    width, height = size
+    buffer = np.memmap(raw_path, dtype=np.uint8, mode='w+', shape=(height, width, 4))
+    for top, band in bands:
+        buffer[top:top + band.height] = np.asarray(band.convert('RGBX'))
+    buffer.flush()
+    return Image.frombuffer('RGBX', size, buffer, 'raw', 'RGBX', 0, 1)
+
+def save_placement_map(path, mosaic_path, base_image_path, tile_size, assignment, tiles, sources,
+                       opacity, blend_mode):
+    """
+    Guarda en JSON qué tesela ocupa cada celda del mosaico, junto con la foto original de
+    cada tesela. Con este mapa animated_video.py compone los primeros planos a partir de
+    las fotos a resolución completa, sin cargar el mosaico.
+    """
+    used, cells = np.unique(assignment, return_inverse=True)
+    placement = {
+        "mosaic": os.path.abspath(mosaic_path),
+        "base_image": os.path.abspath(base_image_path),
+        "tile_size": list(tile_size),
+        "grid": [assignment.shape[1], assignment.shape[0]],
+        "opacity": opacity,
+        "blend": blend_mode,
+        "tiles": [
+            {"tile": os.path.abspath(tiles[i]), "source": os.path.abspath(sources[i]) if sources[i] else None}
+            for i in used.tolist()
+        ],
+        # Fila a fila, índice en "tiles" de la tesela de cada celda
+        "cells": cells.ravel().tolist(),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(placement, f)
+
+def load_placement_map(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+class DeepZoomWriter:
+    """
+    Genera una pirámide Deep Zoom (DZI) a partir de las franjas del mosaico, recibidas de
+    arriba abajo. Cada nivel solo guarda las filas que aún no completan una fila de teselas,
+    y las reduce a la mitad para alimentar al nivel inferior.
+    """
+
+    def __init__(self, dzi_path, size, tile_size=256, tile_format="jpg", quality=85):
+        self.dzi_path = dzi_path
+        self.files_folder = os.path.splitext(dzi_path)[0] + "_files"
+        self.size = size
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.quality = quality
+        self.max_level = int(np.ceil(np.log2(max(size))))
+        # Por nivel: filas pendientes de cortar en teselas, fila de teselas siguiente y
+        # filas pendientes de reducir para el nivel inferior
+        self.pending = [None] * (self.max_level + 1)
+        self.next_row = [0] * (self.max_level + 1)
+        self.carry = [None] * (self.max_level + 1)
+
+    def add_band(self, band):
+        self._add(self.max_level, band)
+
+    def close(self):
+        """Vacía las filas pendientes de todos los niveles y escribe el descriptor .dzi."""
+        for level in range(self.max_level, -1, -1):
+            if level > 0 and self.carry[level] is not None:
+                self._add(level - 1, self.carry[level].reduce(2))
+                self.carry[level] = None
+            if self.pending[level] is not None:
+                self._save_tile_row(level, self.pending[level])
+                self.pending[level] = None
+
+        with open(self.dzi_path, "w", encoding="utf-8") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.tile_format}" '
+                f'Overlap="0" TileSize="{self.tile_size}">\n'
+                f'  <Size Width="{self.size[0]}" Height="{self.size[1]}"/>\n'
+                '</Image>\n'
+            )
+
+    def _add(self, level, band):
+        pending = self._stack(self.pending[level], band)
+        top = 0
+        while pending.height - top >= self.tile_size:
+            self._save_tile_row(level, pending.crop((0, top, pending.width, top + self.tile_size)))
+            top += self.tile_size
+        self.pending[level] = self._rows_from(pending, top)
+
+        if level == 0:
+            return
+        carry = self._stack(self.carry[level], band)
+        even_height = carry.height // 2 * 2
+        self.carry[level] = self._rows_from(carry, even_height)
+        if even_height:
+            self._add(level - 1, carry.crop((0, 0, carry.width, even_height)).reduce(2))
+
+    def _save_tile_row(self, level, rows):
+        folder = os.path.join(self.files_folder, str(level))
+        os.makedirs(folder, exist_ok=True)
+        row = self.next_row[level]
+        for col, left in enumerate(range(0, rows.width, self.tile_size)):
+            tile = rows.crop((left, 0, min(left + self.tile_size, rows.width), rows.height))
+            tile.save(os.path.join(folder, f"{col}_{row}.{self.tile_format}"), quality=self.quality)
+        self.next_row[level] = row + 1
+
+    @staticmethod
+    def _rows_from(image, top):
+        return image.crop((0, top, image.width, image.height)) if top < image.height else None
+
+    @staticmethod
+    def _stack(top, bottom):
+        if top is None:
+            return bottom
+        stacked = Image.new(bottom.mode, (bottom.width, top.height + bottom.height))
+        stacked.paste(top, (0, 0))
+        stacked.paste(bottom, (0, top.height))
+        return stacked
+
+def save_mosaic(mosaic, output_path):
+    """
+    Guarda el mosaico en JPEG y, si el tamaño lo permite, también en WebP.
+    Devuelve las rutas de los archivos generados.
+    """
+    saved = []
+    if max(mosaic.size) > jpeg_max_size:
+        print(f"El mosaico ({mosaic.width}x{mosaic.height}) supera el tamaño máximo de JPEG; no se genera {output_path}")
+        return saved
+    mosaic.save(output_path, format="JPEG", quality=90)
+    saved.append(output_path)
+
+    output_path_webp = output_path.replace(".jpg", ".webp")
+    if max(mosaic.size) > webp_max_size:
+        print(f"El mosaico supera el tamaño máximo de WebP ({webp_max_size}px); no se genera {output_path_webp}")
+    else:
+        mosaic.save(output_path_webp, format="WEBP", quality=90)
+        saved.append(output_path_webp)
+    return saved
+
+def with_deep_zoom(bands, writer):
+    """Pasa las franjas tal cual, enviando además cada una a la pirámide Deep Zoom."""
+    for top, band in bands:
+        writer.add_band(band)
+        yield top, band
+    writer.close()
+
+def parse_job(desired_width, overlay_opacity):
+    """Convierte el ancho y la opacidad de un trabajo, con los valores por defecto si no son válidos."""
+    try:
+        desired_width = int(desired_width)  # Tamaño
+    except (TypeError, ValueError):
+        print("El valor proporcionado para desired_width no es válido. Usando el valor por defecto: 1920.")
+        desired_width = 1920
+
+    # Opcional: Ajustar la opacidad de la imagen principal
+    try:
+        overlay_opacity = float(overlay_opacity)
+        if overlay_opacity < 0 or overlay_opacity > 1:
+            raise ValueError("La opacidad debe estar en el rango [0, 1].")
+    except (TypeError, ValueError):
+        print("El valor proporcionado para overlay_opacity no es válido. Usando el valor por defecto: 0.3.")
+        overlay_opacity = 0.3
+    return desired_width, overlay_opacity
+
+def new_output_path(folder):
+    """Ruta mosaic_<timestamp>.jpg libre, con un sufijo si ya hay un mosaico de ese segundo."""
+    stamp = int(time.time())
+    output_path = os.path.join(folder, f"mosaic_{stamp}.jpg")
+    suffix = 1
+    while os.path.exists(output_path) or os.path.exists(output_path.replace(".jpg", ".rgbx")):
+        output_path = os.path.join(folder, f"mosaic_{stamp}_{suffix}.jpg")
+        suffix += 1
+    return output_path
+
+class MosaicEngine:
+    """
+    Genera mosaicos reutilizando la biblioteca de teselas entre trabajos. El número de fotos,
+    las teselas procesadas y sus colores se cargan una sola vez por tamaño de tesela, y la
+    caché de teselas decodificadas se comparte entre todos los mosaicos del motor. Las fotos
+    nuevas o cambiadas no se ven hasta llamar a refresh().
+    """
+
+    def __init__(self, tiles_folder=tiles_folder, processed_folder=processed_tiles_folder,
+                 output_folder=output_folder, workers=None, tile_cache=256, metrics=None, catalog_path=catalog_file):
+        self.tiles_folder = tiles_folder
+        self.processed_folder = processed_folder
+        self.output_folder = output_folder
+        self.workers = workers
+        self.metrics = metrics or Metrics("mosaic")
+        self.catalog_path = catalog_path
+        self.open_reused_tile = functools.lru_cache(maxsize=tile_cache)(open_tile)
+        self._files = None
+        self._libraries = {}
+        os.makedirs(output_folder, exist_ok=True)
+        os.makedirs(processed_folder, exist_ok=True)
+
+    def refresh(self):
+        """Olvida la biblioteca cargada para volver a recorrer la carpeta de fotos."""
+        self._files = None
+        self._libraries.clear()
+        self.open_reused_tile.cache_clear()
+
+    @property
+    def files(self):
+        """Archivos de la carpeta de fotos, recorrida una sola vez con el catálogo."""
+        if self._files is None:
+            self._files = scan_library([self.tiles_folder], self.catalog_path, metrics=self.metrics)
+        return self._files
+
+    def library(self, tile_size, descriptor_grid=1):
+        """
+        Rutas y colores (o descriptores) de las teselas de tile_size, y el número de teselas
+        cargadas antes de descartar las de otra resolución.
+        """
+        key = (tile_size, descriptor_grid)
+        if key not in self._libraries:
+            print("Procesando teselas...")
+            process_tiles(tile_size, self.workers, self.tiles_folder, self.processed_folder, self.metrics, self.files)
+            with self.metrics.stage("load_tiles"):
+                tiles, tile_colors, tile_sizes = load_tiles(tile_size, descriptor_grid, self.processed_folder)
+            total_tiles = len(tiles)
+            if total_tiles == 0:
+                raise ValueError("No se encontraron imágenes válidas en la carpeta especificada.")
+            tiles, tile_colors = filter_tiles_by_size(tiles, tile_colors, tile_sizes, tile_size)
+            if len(tiles) == 0:
+                raise ValueError("No hay teselas que coincidan con la resolución esperada.")
+            self._libraries[key] = tiles, tile_colors, total_tiles
         else:
-            closest_tile = tiles[closest_tile_idx]
-            used_tiles.add(closest_tile_idx)
-
-        row.paste(closest_tile, (x * tile_width, 0))
-    mosaic.paste(row, (0, y * tile_height))
-
-overlay = base_image.copy()
-draw = Image.new('RGBA', mosaic.size, (0, 0, 0, 0))
-opacity = overlay_opacity
-for y in range(new_height):
-    for x in range(new_width):
-        r, g, b, a = overlay.getpixel((x, y))
-        draw.putpixel((x, y), (r, g, b, int(a * opacity)))
-mosaic = Image.alpha_composite(mosaic, draw)
-output_path = os.path.join(output_folder, f"mosaic_{int(time.time())}.jpg")
-mosaic.convert('RGB').save(output_path, format="JPEG", quality=90)
-
-print(f"Mosaico generado en: {output_path} usando {used_tiles.__len__()} de {total_tiles} teselas.")
-
-output_path_webp = output_path.replace(".jpg", ".webp")
-mosaic.convert('RGB').save(output_path_webp, format="WEBP", quality=90)
-print(f"Mosaico en formato WebP guardado en: {output_path_webp}")
\ No newline at end of file
+            print("Usando la biblioteca de teselas ya cargada.")
+        return self._libraries[key]
+
+    def generate(self, base_image_path, desired_width=1920, overlay_opacity=0.5, assign="greedy",
+                 block_size=1024, descriptor=1, lab=False, blend="normal", stream=False, deepzoom=False,
+                 placement_map=False, max_uses=None, min_distance=3, tile_side=None):
+        """Genera un mosaico y devuelve la ruta del JPEG (o del .rgbx si no cabe en JPEG)."""
+        if descriptor < 1:
+            raise ValueError("descriptor debe ser 1 o mayor.")
+        if assign not in ("greedy", "optimal", "blocked"):
+            raise ValueError(f"Estrategia de asignación desconocida: {assign}")
+        if assign != "greedy" and linear_sum_assignment is None:
+            raise ValueError(f"La asignación '{assign}' requiere scipy (pip install scipy).")
+        if blend != "normal" and blend not in blend_modes:
+            raise ValueError(f"Modo de fusión desconocido: {blend}")
+        if max_uses is not None and max_uses < 1:
+            raise ValueError("max_uses debe ser 1 o mayor.")
+        if tile_side is not None and tile_side < 1:
+            raise ValueError("tile_side debe ser 1 o mayor.")
+
+        base_image = Image.open(base_image_path)
+        base_image = correct_image_orientation(base_image)
+        tile_size, grid_cols, grid_rows = plan_grid(base_image.size, desired_width, len(self.files), tile_side)
+        tile_width, tile_height = tile_size
+
+        print(f"Tamaño de cada tesela: {tile_size}")
+        print(f"Grid: {grid_cols}x{grid_rows} ({grid_cols * grid_rows} teselas)")
+        tiles, tile_colors, total_tiles = self.library(tile_size, descriptor)
+        print(f"Fotos disponibles: {total_tiles}")
+        new_width = grid_cols * tile_width
+        new_height = grid_rows * tile_height
+
+        with self.metrics.stage("cell_colors"):
+            tile_colors, cell_colors = color_features(
+                base_image, tile_colors, grid_cols, grid_rows, tile_size, descriptor, lab
+            )
+        start_time = time.time()
+        with self.metrics.stage("assign"):
+            assignment = assign_tiles(cell_colors, tile_colors, assign, block_size)
+        assignment_time = time.time() - start_time
+        total_error = assignment_error(cell_colors, tile_colors, assignment)
+        print(f"Asignación '{assign}': {assignment_time:.2f}s, error de color total {total_error:.1f} "
+              f"({total_error / max(1, np.count_nonzero(assignment >= 0)):.2f} por celda)")
+        assignment = assignment.reshape(grid_rows, grid_cols)
+        if (assignment < 0).any():
+            repeated_cells = np.count_nonzero(assignment < 0)
+            with self.metrics.stage("schedule_repeats"):
+                assignment, relaxed = schedule_repeats(assignment, cell_colors, tile_colors, max_uses, min_distance)
+            total_error = assignment_error(cell_colors, tile_colors, assignment.ravel())
+            uses = np.bincount(assignment.ravel(), minlength=len(tiles))
+            print(f"Teselas repetidas en {repeated_cells} celdas: hasta {uses.max()} usos por tesela, "
+                  f"distancia mínima {min_distance} ({relaxed} celdas sin respetarla o sobre el límite de usos); "
+                  f"error de color total {total_error:.1f} ({total_error / assignment.size:.2f} por celda)")
+        used_tiles = set(assignment[assignment >= 0].tolist())
+
+        mosaic_size = (new_width, new_height)
+        bands = render_mosaic_bands(base_image, tiles, assignment, tile_size, overlay_opacity, blend,
+                                    self.open_reused_tile)
+        output_path = new_output_path(self.output_folder)
+        raw_path = output_path.replace(".jpg", ".rgbx")
+        if deepzoom:
+            dzi_path = output_path.replace(".jpg", ".dzi")
+            bands = with_deep_zoom(bands, DeepZoomWriter(dzi_path, mosaic_size))
+        # Las franjas se generan al ensamblarlas, así que esta etapa incluye pegar las teselas
+        with self.metrics.stage("compose"):
+            if stream:
+                mosaic = assemble_to_memmap(bands, mosaic_size, raw_path)
+            else:
+                mosaic = assemble_in_memory(bands, mosaic_size)
+        self.metrics.count("cells", grid_cols * grid_rows)
+        cache_info = self.open_reused_tile.cache_info()
+        self.metrics.counters["decoded_tile_cache_hits"] = cache_info.hits
+        self.metrics.counters["decoded_tile_cache_misses"] = cache_info.misses
+
+        if deepzoom:
+            print(f"Pirámide Deep Zoom guardada en: {dzi_path} (abrir viewer.html?dzi={dzi_path}"
+                  f"&width={mosaic_size[0]}&height={mosaic_size[1]})")
+
+        with self.metrics.stage("encode"):
+            saved = save_mosaic(mosaic, output_path)
+        self.metrics.count("mosaics")
+        if output_path in saved:
+            print(f"Mosaico generado en: {output_path} usando {used_tiles.__len__()} de {total_tiles} teselas.")
+        if len(saved) > 1:
+            print(f"Mosaico en formato WebP guardado en: {saved[1]}")
+
+        if placement_map:
+            index = load_tile_index(tile_size, self.processed_folder)
+            sources = [index.get(os.path.basename(tile), {}).get("source") for tile in tiles]
+            map_path = output_path.replace(".jpg", ".json")
+            save_placement_map(
+                map_path, output_path if saved else raw_path, base_image_path, tile_size, assignment, tiles, sources,
+                overlay_opacity, blend,
+            )
+            print(f"Mapa de teselas guardado en: {map_path}")
+
+        if stream:
+            del mosaic
+            if saved:
+                os.remove(raw_path)
+            else:
+                print(f"Datos RGBX sin comprimir ({new_width}x{new_height}) en: {raw_path}")
+                return raw_path
+        return output_path if saved else None
+
+# Modos batch y servidor
+
+def read_batch_file(path):
+    """
+    Lee un archivo de trabajos: una línea por mosaico con los mismos argumentos posicionales
+    que el script (imagen base, ancho y opacidad). Las líneas vacías y las que empiezan por #
+    se ignoran.
+    """
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) > 3:
+                raise ValueError(f"Línea de trabajo no válida en {path}: {line.strip()}")
+            base_image, desired_width, overlay_opacity = fields + ["1920", "0.5"][len(fields) - 1:]
+            jobs.append((base_image, *parse_job(desired_width, overlay_opacity)))
+    return jobs
+
+def serve(engine, port, options):
+    """
+    Atiende trabajos por HTTP en localhost con el motor ya cargado. POST /mosaic recibe un
+    JSON con base_image y, opcionalmente, width, opacity y cualquiera de las opciones de
+    generate; responde con la ruta del mosaico. POST /refresh vuelve a leer la biblioteca.
+    Los trabajos se atienden de uno en uno.
+    """
+    job_fields = {"base_image": "base_image_path", "width": "desired_width", "opacity": "overlay_opacity"}
+    job_fields.update((name, name) for name in options)
+
+    class MosaicRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/refresh":
+                    engine.refresh()
+                    status, result = 200, {"refreshed": True}
+                elif self.path == "/mosaic":
+                    unknown = set(job) - set(job_fields)
+                    if unknown:
+                        raise ValueError(f"Parámetros desconocidos: {', '.join(sorted(unknown))}")
+                    if "base_image" not in job:
+                        raise ValueError("Falta base_image.")
+                    kwargs = dict(options, **{job_fields[name]: value for name, value in job.items()})
+                    kwargs["desired_width"], kwargs["overlay_opacity"] = parse_job(
+                        kwargs.get("desired_width", 1920), kwargs.get("overlay_opacity", 0.5)
+                    )
+                    start_time = time.time()
+                    output_path = engine.generate(**kwargs)
+                    status, result = 200, {"output": output_path, "seconds": round(time.time() - start_time, 3)}
+                else:
+                    status, result = 404, {"error": f"Ruta desconocida: {self.path}"}
+            except (ValueError, TypeError, OSError) as e:
+                status, result = 400, {"error": str(e)}
+            except Exception as e:
+                status, result = 500, {"error": str(e)}
+            body = json.dumps(result).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(("127.0.0.1", port), MosaicRequestHandler)
+    print(f"Esperando trabajos en http://127.0.0.1:{port}/mosaic (Ctrl+C para terminar)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def run_jobs(engine, args):
+    options = {
+        "assign": args.assign,
+        "block_size": args.block_size,
+        "descriptor": args.descriptor,
+        "lab": args.lab,
+        "blend": args.blend,
+        "stream": args.stream,
+        "deepzoom": args.deepzoom,
+        "placement_map": args.placement_map,
+        "max_uses": args.max_uses,
+        "min_distance": args.min_distance,
+        "tile_side": args.tile_size,
+    }
+
+    if args.serve is not None:
+        serve(engine, args.serve, options)
+        return
+
+    if args.batch:
+        jobs = read_batch_file(args.batch)
+    else:
+        jobs = [(args.base_image, *parse_job(args.desired_width, args.overlay_opacity))]
+    for i, (base_image_path, desired_width, overlay_opacity) in enumerate(jobs, 1):
+        if len(jobs) > 1:
+            print(f"Trabajo {i}/{len(jobs)}: {base_image_path}")
+        start_time = time.time()
+        try:
+            engine.generate(base_image_path, desired_width, overlay_opacity, **options)
+        except (ValueError, OSError) as e:
+            if len(jobs) == 1:
+                raise
+            print(f"Error en el trabajo {base_image_path}: {e}")
+            continue
+        if len(jobs) > 1:
+            print(f"Trabajo {i}/{len(jobs)} terminado en {time.time() - start_time:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generar un mosaico de fotos a partir de una imagen base.")
+    parser.add_argument("base_image", nargs="?", default='path_to_base_image.png', help="Imagen principal")
+    parser.add_argument("desired_width", nargs="?", default="1920", help="Ancho del mosaico en píxeles")
+    parser.add_argument("overlay_opacity", nargs="?", default="0.5", help="Opacidad de la imagen principal sobre el mosaico [0, 1]")
+    parser.add_argument("--assign", choices=("greedy", "optimal", "blocked"), default="greedy",
+                        help="Estrategia de asignación de teselas a celdas")
+    parser.add_argument("--block-size", type=int, default=1024,
+                        help="Celdas por bloque en la asignación blocked")
+    parser.add_argument("--descriptor", type=int, default=1, metavar="N",
+                        help="Comparar N x N colores medios por tesela y celda en lugar de uno solo")
+    parser.add_argument("--lab", action="store_true",
+                        help="Comparar los colores en el espacio CIELAB en lugar de RGB")
+    parser.add_argument("--blend", choices=("normal", "multiply", "soft-light"), default="normal",
+                        help="Modo de fusión de la imagen principal sobre el mosaico")
+    parser.add_argument("--tiles-folder", default=tiles_folder, help="Carpeta con las fotos")
+    parser.add_argument("--processed-folder", default=processed_tiles_folder,
+                        help="Carpeta para guardar las teselas procesadas")
+    parser.add_argument("--output-folder", default=output_folder, help="Carpeta para guardar los mosaicos")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Procesos para preparar las teselas (por defecto, uno por núcleo)")
+    parser.add_argument("--tile-size", type=int, default=None, metavar="PX",
+                        help="Lado de las teselas en píxeles (por defecto se calcula para no repetir fotos)")
+    parser.add_argument("--max-uses", type=int, default=None, metavar="N",
+                        help="Usos máximos de cada tesela cuando hay más celdas que fotos "
+                             "(por defecto, los justos para cubrir el grid)")
+    parser.add_argument("--min-distance", type=int, default=3, metavar="CELDAS",
+                        help="Distancia mínima, en celdas, entre dos usos de la misma tesela")
+    parser.add_argument("--tile-cache", type=int, default=256,
+                        help="Teselas decodificadas que se mantienen en memoria para reutilizarlas")
+    parser.add_argument("--stream", action="store_true",
+                        help="Escribir el mosaico por franjas en un buffer en disco en lugar de en memoria")
+    parser.add_argument("--deepzoom", action="store_true",
+                        help="Generar también una pirámide de teselas Deep Zoom (.dzi) para viewer.html")
+    parser.add_argument("--placement-map", action="store_true",
+                        help="Guardar un mapa JSON con la tesela y la foto original de cada celda")
+    parser.add_argument("--catalog", default=catalog_file,
+                        help="Catálogo de la biblioteca compartido con los otros scripts ('' para no guardarlo)")
+    parser.add_argument("--metrics", metavar="ARCHIVO",
+                        help="Guardar en JSON el tiempo de cada etapa, los contadores y el pico de memoria")
+    parser.add_argument("--profile", metavar="ARCHIVO",
+                        help="Guardar un perfil de cProfile de la ejecución (se abre con pstats o snakeviz)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--batch", metavar="ARCHIVO",
+                      help="Generar los mosaicos listados en un archivo (imagen, ancho y opacidad por línea)")
+    mode.add_argument("--serve", type=int, metavar="PUERTO",
+                      help="Atender trabajos por HTTP en localhost, con la biblioteca cargada una sola vez")
+    args = parser.parse_args()
+    if args.descriptor < 1:
+        parser.error("--descriptor debe ser 1 o mayor.")
+    if args.max_uses is not None and args.max_uses < 1:
+        parser.error("--max-uses debe ser 1 o mayor.")
+    if args.tile_size is not None and args.tile_size < 1:
+        parser.error("--tile-size debe ser 1 o mayor.")
+    if args.assign != "greedy" and linear_sum_assignment is None:
+        parser.error(f"La asignación '{args.assign}' requiere scipy (pip install scipy).")
+
+    with Metrics("mosaic", args.metrics, args.profile) as metrics:
+        engine = MosaicEngine(args.tiles_folder, args.processed_folder, args.output_folder, args.workers,
+                              args.tile_cache, metrics, args.catalog)
+        run_jobs(engine, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Catálogo persistente de la biblioteca de fotos, compartido por mosaic.py,
+remove-duplicates.py y run_face_recognition.py.
+
+La biblioteca se recorre una sola vez con os.scandir, que ya da el tamaño y la fecha de
+modificación de cada archivo. Con contents, además se lee cada archivo nuevo o cambiado
+una única vez para obtener su hash BLAKE2, sus dimensiones, la orientación EXIF y una
+miniatura; los archivos que no han cambiado desde la última vez no se vuelven a abrir.
+
+Uso (refresco nocturno del catálogo):
+    python photo_catalog.py /fotos /fotos_movil --workers 8
+"""
+
+import argparse
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from instrumentation import Metrics
+
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass  # Sin pillow-heif, de las fotos HEIC solo se guarda el hash
+
+catalog_file = 'photo_catalog.npz'
+image_extensions = ('.jpg', '.jpeg', '.png', '.heic', '.heif', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+thumbnail_size = 16           # Lado de la miniatura (deformada al cuadrado, como en un dHash)
+max_image_bytes = 256 * 2 ** 20  # Las imágenes mayores se leen por bloques y no se decodifican
+buffer_size = 1024 * 1024
+
+
+def catalog_entry(size, mtime, content_hash=None, width=-1, height=-1, orientation=0, thumbnail=None):
+    """
+    Entrada del catálogo. content_hash None indica que aún no se ha leído el archivo; una
+    anchura de -1, que no se pudo decodificar como imagen.
+    """
+    return {
+        "size": size,
+        "mtime": mtime,
+        "hash": content_hash,
+        "width": width,
+        "height": height,
+        "orientation": orientation,
+        "thumbnail": thumbnail,
+    }
+
+
+def load_catalog(path=catalog_file):
+    """Carga el catálogo: ruta absoluta -> entrada (catalog_entry)."""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as data:
+            paths = bytes(data["paths"]).decode("utf-8").split("\0") if len(data["sizes"]) else []
+            hashes = dict(zip(data["hash_rows"].tolist(), data["hashes"]))
+            thumbnails = dict(zip(data["thumbnail_rows"].tolist(), data["thumbnails"]))
+            return {
+                file_path: catalog_entry(
+                    size, mtime, hashes[row].tobytes().hex() if row in hashes else None, width, height, orientation,
+                    thumbnails.get(row),
+                )
+                for row, (file_path, size, mtime, (width, height), orientation) in enumerate(zip(
+                    paths, data["sizes"].tolist(), data["mtimes"].tolist(), data["dimensions"].tolist(),
+                    data["orientations"].tolist(),
+                ))
+            }
+    except Exception as e:
+        print(f"No se pudo leer el catálogo {path}: {e}")
+        return {}
+
+
+def save_catalog(path, catalog):
+    """
+    Guarda el catálogo comprimido. Las rutas van unidas en un solo bloque UTF-8 (sin
+    rellenar cada una hasta la más larga), los hashes en binario y solo se guardan los
+    hashes y miniaturas de los archivos ya leídos.
+    """
+    paths = sorted(catalog)
+    entries = [catalog[file_path] for file_path in paths]
+    hash_rows = [row for row, entry in enumerate(entries) if entry["hash"] is not None]
+    thumbnail_rows = [row for row, entry in enumerate(entries) if entry["thumbnail"] is not None]
+    temp_path = path + ".tmp.npz"
+    np.savez_compressed(
+        temp_path,
+        paths=np.frombuffer("\0".join(paths).encode("utf-8"), dtype=np.uint8),
+        sizes=np.array([entry["size"] for entry in entries], dtype=np.int64),
+        mtimes=np.array([entry["mtime"] for entry in entries], dtype=np.float64),
+        hash_rows=np.array(hash_rows, dtype=np.int64),
+        hashes=np.frombuffer(
+            b"".join(bytes.fromhex(entries[row]["hash"]) for row in hash_rows), dtype=np.uint8
+        ).reshape(-1, hashlib.blake2b().digest_size),
+        dimensions=np.array([(entry["width"], entry["height"]) for entry in entries], dtype=np.int32).reshape(-1, 2),
+        orientations=np.array([entry["orientation"] for entry in entries], dtype=np.int8),
+        thumbnail_rows=np.array(thumbnail_rows, dtype=np.int64),
+        thumbnails=np.array(
+            [entries[row]["thumbnail"] for row in thumbnail_rows], dtype=np.uint8
+        ).reshape(-1, thumbnail_size, thumbnail_size, 3),
+    )
+    os.replace(temp_path, path)
+
+
+def walk_files(folder):
+    """
+    Recorre una carpeta y sus subcarpetas con os.scandir y devuelve sus archivos como
+    os.DirEntry, en el mismo orden que os.walk.
+    """
+    try:
+        with os.scandir(folder) as iterator:
+            entries = list(iterator)
+    except OSError as e:
+        print(f"No se pudo leer la carpeta {folder}: {e}")
+        return
+    subfolders = []
+    for entry in entries:
+        if not entry.is_dir():
+            yield entry
+        elif not entry.is_symlink():
+            # Como os.walk, sin entrar en los enlaces a carpetas
+            subfolders.append(entry.path)
+    for subfolder in subfolders:
+        yield from walk_files(subfolder)
+
+
+def read_contents(file_path):
+    """
+    Lee un archivo una sola vez: hash BLAKE2 de su contenido y, si es una imagen, sus
+    dimensiones, su orientación EXIF y una miniatura RGB ya orientada.
+    Devuelve (hash, anchura, altura, orientación, miniatura).
+    """
+    hash_blake2 = hashlib.blake2b()
+    if not file_path.lower().endswith(image_extensions) or os.path.getsize(file_path) > max_image_bytes:
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as f:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                hash_blake2.update(view[:read])
+        return hash_blake2.hexdigest(), -1, -1, 0, None
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    hash_blake2.update(data)
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            orientation = img.getexif().get(0x0112, 1)
+            img.draft('RGB', (thumbnail_size * 4, thumbnail_size * 4))
+            if img.format != 'HEIF':
+                # libheif ya aplica la rotación de las fotos HEIC
+                img = ImageOps.exif_transpose(img)
+            img = img.convert('RGB')
+            thumbnail = np.asarray(img.resize((thumbnail_size, thumbnail_size), Image.BOX), dtype=np.uint8)
+    except Exception:
+        return hash_blake2.hexdigest(), -1, -1, 0, None
+    return hash_blake2.hexdigest(), width, height, orientation, thumbnail
+
+
+def safe_read_contents(file_path):
+    try:
+        return read_contents(file_path)
+    except Exception as e:
+        print(f"Error al leer {file_path}: {e}")
+        return None
+
+
+def scan_library(folders, catalog_path=catalog_file, contents=False, extensions=None, workers=None, metrics=None):
+    """
+    Recorre las carpetas y devuelve (carpeta, ruta, entrada) para cada archivo, en el orden
+    de os.walk. Las entradas de los archivos con el mismo tamaño y fecha de modificación
+    que en el catálogo se reutilizan; con contents, los nuevos o cambiados se leen en
+    paralelo (read_contents). Si algo ha cambiado, el catálogo actualizado se guarda en
+    catalog_path (si no es vacío), sin tocar las entradas de otras carpetas.
+    """
+    metrics = metrics or Metrics("scan_library")
+    catalog = load_catalog(catalog_path)
+    files = []
+    scanned = set()
+    changed = False
+    with metrics.stage("scan"):
+        for folder in folders:
+            for dir_entry in walk_files(folder):
+                if extensions and not dir_entry.name.lower().endswith(extensions):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError as e:
+                    print(f"Error al leer {dir_entry.path}: {e}")
+                    metrics.count("errors")
+                    continue
+                key = os.path.abspath(dir_entry.path)
+                entry = catalog.get(key)
+                if entry is None or (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime):
+                    entry = catalog[key] = catalog_entry(stat.st_size, stat.st_mtime)
+                    changed = True
+                scanned.add(key)
+                files.append((folder, dir_entry.path, entry))
+    metrics.count("files_scanned", len(files))
+
+    if contents:
+        pending = [(file_path, entry) for _, file_path, entry in files if entry["hash"] is None]
+        metrics.count("catalog_hits", len(files) - len(pending))
+        metrics.count("catalog_misses", len(pending))
+        with metrics.stage("read_contents"), ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(safe_read_contents, [file_path for file_path, _ in pending], chunksize=16)
+            for done, ((file_path, entry), result) in enumerate(zip(pending, results), 1):
+                if result is None:
+                    metrics.count("errors")
+                else:
+                    entry["hash"], entry["width"], entry["height"], entry["orientation"], entry["thumbnail"] = result
+                    metrics.count("bytes_read", entry["size"])
+                    changed = True
+                metrics.progress("Archivos leídos", done, len(pending))
+
+    if catalog_path:
+        # Olvidar los archivos borrados de las carpetas recorridas
+        roots = tuple(os.path.join(os.path.abspath(folder), "") for folder in folders)
+        for key in [key for key in catalog if key.startswith(roots) and key not in scanned]:
+            if not extensions or key.lower().endswith(extensions):
+                del catalog[key]
+                changed = True
+        if changed or not os.path.exists(catalog_path):
+            with metrics.stage("save_catalog"):
+                save_catalog(catalog_path, catalog)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Actualizar el catálogo de una biblioteca de fotos.")
+    parser.add_argument("folders", nargs="+", help="Carpetas de fotos (se recorren con sus subcarpetas)")
+    parser.add_argument("--catalog", default=catalog_file, help="Archivo del catálogo")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos de lectura (por defecto, uno por núcleo)")
+    parser.add_argument("--metrics", metavar="ARCHIVO",
+                        help="Guardar en JSON el tiempo de cada etapa, los contadores y el pico de memoria")
+    args = parser.parse_args()
+
+    with Metrics("photo_catalog", args.metrics) as metrics:
+        files = scan_library(args.folders, args.catalog, True, workers=args.workers, metrics=metrics)
+        images = sum(entry["width"] >= 0 for _, _, entry in files)
+        print(f"Catálogo {args.catalog}: {len(files)} archivos, {images} imágenes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,357 @@
 import os
+import json
 import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
 
-def calculate_md5(file_path):
+from instrumentation import Metrics
+from photo_catalog import catalog_file, scan_library
+
+try:
+    import pyheif
+except ImportError:
+    pyheif = None  # Solo necesario para comparar fotos HEIC en el modo --similar
+
+chunk_size = 64 * 1024       # Bytes del principio y del final que se comparan antes del hash completo
+buffer_size = 1024 * 1024    # Tamaño de lectura para el hash completo
+cache_file = 'duplicates_cache.json'
+image_extensions = ('.jpg', '.jpeg', '.png', '.heic', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+def calculate_partial_hash(file_path, size):
     """
-    Calcula el hash MD5 de un archivo.
+    Hash BLAKE2 del primer y el último bloque de un archivo. Si el archivo cabe en esos
+    dos bloques, es el hash del archivo completo.
     """
-    hash_md5 = hashlib.md5()
+    hash_blake2 = hashlib.blake2b()
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        hash_blake2.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            hash_blake2.update(f.read(chunk_size))
+    return hash_blake2.hexdigest()
 
-def remove_duplicate_images(directory):
+def calculate_full_hash(file_path):
     """
-    Busca y elimina imágenes duplicadas en un directorio y sus subdirectorios.
+    Calcula el hash BLAKE2 de un archivo completo, leyendo en bloques grandes sobre un
+    mismo buffer.
     """
-    md5_map = {}
-    duplicates = []
+    hash_blake2 = hashlib.blake2b()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            hash_blake2.update(view[:read])
+    return hash_blake2.hexdigest()
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
+def calculate_dhash(file_path, hash_size=8):
+    """
+    Hash perceptual (dHash) de una imagen: compara el brillo de píxeles vecinos en una
+    miniatura de (hash_size + 1) x hash_size. Las copias reescaladas o recomprimidas de una
+    foto dan el mismo hash o uno a muy poca distancia de Hamming. Los JPEG se decodifican
+    directamente a 1/8 de su tamaño. Devuelve el hash y los píxeles de la imagen original.
+    """
+    if file_path.lower().endswith('.heic'):
+        heif_file = pyheif.read(file_path)
+        img = Image.frombytes(heif_file.mode, heif_file.size, heif_file.data, "raw", heif_file.mode, heif_file.stride)
+    else:
+        img = Image.open(file_path)
+    pixels = img.width * img.height
+    img.draft('L', (hash_size * 4, hash_size * 4))
+    return dhash(ImageOps.exif_transpose(img), hash_size), pixels
 
-            # Calcula el hash MD5 del archivo
-            try:
-                file_md5 = calculate_md5(file_path)
+def dhash(img, hash_size=8):
+    """dHash de una imagen ya orientada (calculate_dhash)."""
+    small = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def load_hash_cache(path):
+    """
+    Hashes ya calculados: ruta -> [tamaño, fecha de modificación, hash parcial, hash completo,
+    dHash, píxeles de la imagen].
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {path: entry + [None] * (6 - len(entry)) for path, entry in cache.items()}
+
+def save_hash_cache(path, cache):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(temp_path, path)
 
-                if file_md5 in md5_map:
-                    # Si ya existe el hash, añade el archivo a la lista de duplicados
-                    duplicates.append(file_path)
-                else:
-                    # Almacena el hash y la ruta del archivo
-                    md5_map[file_md5] = file_path
+def group_by(files, key):
+    groups = {}
+    for file in files:
+        groups.setdefault(key(file), []).append(file)
+    return [group for group in groups.values() if len(group) > 1]
 
-            except Exception as e:
+def safe_hash(function, file):
+    try:
+        return function(*file)
+    except Exception as e:
+        print(f"Error al procesar el archivo {file[0]}: {e}")
+        return None
+
+def scan_files(directory, cache):
+    """
+    Lista los archivos de un directorio y sus subdirectorios con su entrada de la caché,
+    o una entrada vacía si el archivo es nuevo o cambió de tamaño o fecha.
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError as e:
                 print(f"Error al procesar el archivo {file_path}: {e}")
+                continue
+            entry = cache.get(file_path)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime]:
+                entry = [stat.st_size, stat.st_mtime, None, None, None, None]
+            files.append((file_path, entry))
+    return files
+
+def catalog_files(directory, catalog_path, workers=None, metrics=None):
+    """
+    Como scan_files, pero a partir del catálogo de photo_catalog: cada archivo nuevo o
+    cambiado se lee una sola vez, y el hash completo, el dHash (de la miniatura) y los
+    píxeles salen del catálogo. El hash completo ocupa también la posición del parcial,
+    así que estas entradas no deben guardarse en la caché de hashes.
+    """
+    files = []
+    for _, file_path, photo in scan_library([directory], catalog_path, True, workers=workers, metrics=metrics):
+        if photo["hash"] is None:
+            continue
+        image_hash = pixels = None
+        if photo["thumbnail"] is not None:
+            image_hash = dhash(Image.fromarray(photo["thumbnail"]))
+            pixels = photo["width"] * photo["height"]
+        files.append((file_path, [photo["size"], photo["mtime"], photo["hash"], photo["hash"], image_hash, pixels]))
+    return files
+
+def save_scanned_files(cache_path, files):
+    if cache_path:
+        save_hash_cache(cache_path, {
+            path: entry for path, entry in files if any(value is not None for value in entry[2:])
+        })
+
+def find_duplicates(directory, workers=8, cache_path=cache_file, metrics=None, catalog_path=None):
+    """
+    Devuelve los grupos de archivos idénticos de un directorio y sus subdirectorios, en el
+    orden en que se recorren. Se descarta por etapas: primero los archivos de tamaño único,
+    después los que difieren en el primer o el último bloque, y solo el resto se lee
+    entero. Los hashes se guardan en cache_path por ruta, tamaño y fecha de modificación.
+    Con catalog_path, los hashes salen del catálogo de la biblioteca (catalog_files).
+    """
+    metrics = metrics or Metrics("find_duplicates")
+    if catalog_path:
+        files = catalog_files(directory, catalog_path, workers, metrics)
+        cache_path = None
+    else:
+        with metrics.stage("scan"):
+            files = scan_files(directory, load_hash_cache(cache_path) if cache_path else {})
+    metrics.count("files", len(files))
+
+    def hash_stage(group, position, function, name, label, bytes_read):
+        """Calcula en paralelo el hash de la posición indicada para los archivos que no lo tienen."""
+        pending = [file for file in group if file[1][position] is None]
+        metrics.count("cache_hits", len(group) - len(pending))
+        metrics.count("cache_misses", len(pending))
+        with metrics.stage(name), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda file: safe_hash(function, file), pending)
+            for done, ((file_path, entry), digest) in enumerate(zip(pending, results), 1):
+                entry[position] = digest
+                metrics.count("bytes_read", bytes_read(entry[0]))
+                metrics.progress(label, done, len(pending))
+        return [file for file in group if file[1][position] is not None]
+
+    candidates = [file for group in group_by(files, lambda file: file[1][0]) for file in group]
+    print(f"{len(files)} archivos, {len(candidates)} con un tamaño repetido.")
+    candidates = hash_stage(candidates, 2, lambda file_path, entry: calculate_partial_hash(file_path, entry[0]),
+                            "partial_hash", "Hash parcial", lambda size: min(size, 2 * chunk_size))
+    candidates = [file for group in group_by(candidates, lambda file: (file[1][0], file[1][2])) for file in group]
+    print(f"{len(candidates)} candidatos tras comparar el principio y el final.")
+    # Si los bloques parciales cubren todo el archivo, el hash parcial ya es el completo
+    for file_path, entry in candidates:
+        if entry[0] <= 2 * chunk_size:
+            entry[3] = entry[2]
+    candidates = hash_stage(candidates, 3, lambda file_path, entry: calculate_full_hash(file_path),
+                            "full_hash", "Hash completo", lambda size: size)
+
+    save_scanned_files(cache_path, files)
+    order = {file_path: i for i, (file_path, _) in enumerate(files)}
+    groups = group_by(candidates, lambda file: (file[1][0], file[1][3]))
+    return sorted(
+        (sorted((file_path for file_path, _ in group), key=order.get) for group in groups),
+        key=lambda group: order[group[0]],
+    )
+
+def hamming_distances(a, b):
+    """Distancias de Hamming entre dos arrays de hashes de 64 bits (uint64)."""
+    return np.bitwise_count(np.bitwise_xor(a, b))
+
+def near_duplicate_pairs(hashes, max_distance):
+    """
+    Pares (i, j) de hashes a distancia de Hamming <= max_distance, sin comparar todos con
+    todos (multi-index hashing): se parten los 64 bits en max_distance + 1 trozos y, como dos
+    hashes a esa distancia coinciden por completo en al menos un trozo, solo se comparan
+    los hashes que comparten algún trozo.
+    """
+    pairs = set()
+    bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        keys = (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # Límites de los tramos de hashes con el mismo trozo
+        bounds_runs = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1], True])
+        for start, end in zip(bounds_runs[:-1], bounds_runs[1:]):
+            if end - start < 2:
+                continue
+            members = order[start:end]
+            member_hashes = hashes[members]
+            # Por bloques de filas, para que un tramo muy grande (p. ej. muchas fotos lisas)
+            # no necesite una matriz m x m
+            block = max(1, (1 << 20) // len(members))
+            for block_start in range(0, len(members), block):
+                distances = hamming_distances(
+                    member_hashes[block_start:block_start + block, None], member_hashes[None, block_start:]
+                )
+                first, second = np.nonzero(np.triu(distances <= max_distance, k=1))
+                pairs.update(zip(members[first + block_start].tolist(), members[second + block_start].tolist()))
+    return pairs
+
+def find_similar_images(directory, max_distance=6, workers=None, cache_path=cache_file, metrics=None,
+                        catalog_path=None):
+    """
+    Devuelve los grupos de imágenes casi iguales (copias reescaladas, recomprimidas o
+    convertidas de formato) según su dHash. Dentro de cada grupo, la imagen de mayor
+    resolución va primero. Con catalog_path, los dHash salen de las miniaturas del catálogo;
+    las imágenes que no se pudieron decodificar al catalogarlas se vuelven a intentar aquí.
+    """
+    metrics = metrics or Metrics("find_similar_images")
+    if catalog_path:
+        files = catalog_files(directory, catalog_path, workers, metrics)
+        cache_path = None
+    else:
+        with metrics.stage("scan"):
+            files = scan_files(directory, load_hash_cache(cache_path) if cache_path else {})
+    images = [file for file in files if file[0].lower().endswith(image_extensions)]
+    pending = [file for file in images if file[1][4] is None]
+    print(f"{len(images)} imágenes, {len(pending)} sin hash perceptual en la caché.")
+    metrics.count("files", len(files))
+    metrics.count("cache_hits", len(images) - len(pending))
+    metrics.count("cache_misses", len(pending))
+    with metrics.stage("dhash"), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(safe_hash, [calculate_dhash] * len(pending), [(path,) for path, _ in pending], chunksize=16)
+        for done, ((file_path, entry), result) in enumerate(zip(pending, results), 1):
+            if result is not None:
+                entry[4], entry[5] = result
+                metrics.count("bytes_read", entry[0])
+            metrics.progress("Hash perceptual", done, len(pending))
+    save_scanned_files(cache_path, files)
+
+    images = [file for file in images if file[1][4] is not None]
+    hashes = np.array([entry[4] for _, entry in images], dtype=np.uint64)
+
+    # Grupos: componentes conexas de los pares cercanos (union-find)
+    parent = list(range(len(images)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    with metrics.stage("compare"):
+        pairs = near_duplicate_pairs(hashes, max_distance)
+    for i, j in pairs:
+        parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(images)):
+        groups.setdefault(find(i), []).append(i)
+    similar = []
+    for group in sorted(groups.values()):
+        group = np.array(sorted(group, key=lambda i: (-images[i][1][5], -images[i][1][0], i)))
+        # Los grupos pueden encadenar imágenes cada vez más distintas: se separan en grupos
+        # de la imagen de mayor resolución con las que están cerca de ella, y se repite con el resto
+        while len(group) > 1:
+            near = hamming_distances(hashes[group], hashes[group[0]]) <= max_distance
+            if near.sum() > 1:
+                similar.append([images[i][0] for i in group[near]])
+            group = group[~near]
+    return similar
+
+def remove_duplicate_images(directory, workers=8, cache_path=cache_file, dry_run=False, similar=None, metrics=None,
+                            catalog_path=None):
+    """
+    Busca y elimina imágenes duplicadas en un directorio y sus subdirectorios. De cada
+    grupo de archivos idénticos se conserva el primero encontrado. Con similar (distancia
+    máxima entre dHash, de 0 a 62), se buscan también imágenes casi iguales y de cada
+    grupo se conserva la de mayor resolución; los archivos idénticos que no son imágenes
+    se siguen agrupando por su contenido.
+    """
+    metrics = metrics or Metrics("remove_duplicates")
+    groups = find_duplicates(directory, workers, cache_path, metrics, catalog_path)
+    if similar is not None:
+        similar_groups = find_similar_images(directory, similar, workers, cache_path=cache_path, metrics=metrics,
+                                             catalog_path=catalog_path)
+        for group in similar_groups:
+            print("Imágenes similares: " + ", ".join(group))
+        # Los grupos de imágenes idénticas ya están en los de imágenes similares
+        in_similar = {file_path for group in similar_groups for file_path in group}
+        groups = similar_groups + [group for group in groups if in_similar.isdisjoint(group)]
+    duplicates = [file_path for group in groups for file_path in group[1:]]
+    metrics.count("duplicates", len(duplicates))
 
     # Elimina los duplicados
     for duplicate in duplicates:
+        if dry_run:
+            print(f"Duplicado: {duplicate}")
+            continue
         try:
             os.remove(duplicate)
+            metrics.count("removed")
             print(f"Eliminado: {duplicate}")
         except Exception as e:
             print(f"Error al eliminar el archivo {duplicate}: {e}")
 
 if __name__ == "__main__":
-    # Cambia 'path_to_directory' por la ruta del directorio que deseas analizar
-    path_to_directory = input("Introduce la ruta del directorio a analizar: ").strip()
+    parser = argparse.ArgumentParser(description="Eliminar imágenes duplicadas de un directorio y sus subdirectorios.")
+    parser.add_argument("directory", nargs="?", help="Directorio a analizar (si no se indica, se pregunta)")
+    parser.add_argument("--workers", type=int, default=8, help="Hilos de lectura para calcular los hashes")
+    parser.add_argument("--cache", default=cache_file,
+                        help="Archivo donde se guardan los hashes entre ejecuciones ('' para no usarlo)")
+    parser.add_argument("--dry-run", action="store_true", help="Solo listar los duplicados, sin eliminarlos")
+    parser.add_argument("--similar", type=int, nargs="?", const=6, metavar="DISTANCIA",
+                        help="Buscar también imágenes casi iguales (reescaladas, recomprimidas o convertidas), "
+                             "con una distancia máxima entre hashes perceptuales de 0 a 62 (6 por defecto)")
+    parser.add_argument("--catalog", nargs="?", const=catalog_file, default=None, metavar="ARCHIVO",
+                        help="Usar el catálogo de la biblioteca (photo_catalog.py) en lugar de la caché de "
+                             f"hashes: cada foto nueva o cambiada se lee una sola vez ({catalog_file} por defecto)")
+    parser.add_argument("--metrics", metavar="ARCHIVO",
+                        help="Guardar en JSON el tiempo de cada etapa, los contadores y el pico de memoria")
+    parser.add_argument("--profile", metavar="ARCHIVO", help="Guardar un perfil de cProfile de la ejecución")
+    args = parser.parse_args()
+    if args.similar is not None and not 0 <= args.similar <= 62:
+        parser.error("--similar debe estar entre 0 y 62")
+
+    path_to_directory = args.directory
+    if path_to_directory is None:
+        path_to_directory = input("Introduce la ruta del directorio a analizar: ").strip()
 
     if os.path.isdir(path_to_directory):
-        remove_duplicate_images(path_to_directory)
+        with Metrics("remove_duplicates", args.metrics, args.profile) as metrics:
+            remove_duplicate_images(path_to_directory, args.workers, args.cache, args.dry_run, args.similar, metrics,
+                                    args.catalog)
     else:
         print(f"La ruta proporcionada no es un directorio válido: {path_to_directory}")
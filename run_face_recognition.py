@@ -2,13 +2,18 @@
 Usage (examples):
     python run_face_recognition.py /folder1 /folder2 output_faces.json faces_folder
     python run_face_recognition.py /folder1 /folder2 /folder3 output_faces.json faces_folder updated_faces.json
+    python run_face_recognition.py /folder1 output_faces.json faces_folder --incremental
 
 This script demonstrates how to:
 1. Accept multiple image folders as input (recursively processed).
 2. Detect faces in each image using the face_recognition library.
 3. Save cropped faces in a separate folder (faces_folder).
-4. Generate a single JSON file (output_faces.json) with data about all detected faces.
-5. (Optional) Load an updated JSON file (updated_faces.json) to recategorize faces.
+4. Generate a single JSON file (output_faces.json) with data about all detected faces,
+   and their encodings as a float32 array (output_faces_encodings.npy).
+5. (Optional) Load an updated JSON file (updated_faces.json) to recategorize faces: unlabeled
+   faces get the name of the closest confirmed face, and with --cluster the rest are grouped.
+6. (Optional) With --incremental, only analyze images added or changed since the last run,
+   keeping face IDs and labels (output_faces_manifest.json records what was processed).
 
 Important:
 - If you want to process HEIC files, install pillow-heif (pip install pillow-heif) 
@@ -17,95 +22,441 @@ Important:
 
 import os
 import json
+import time
 import argparse
+import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import face_recognition
 from PIL import Image
 import numpy as np
 
+from instrumentation import Metrics
+from photo_catalog import catalog_file, scan_library
+
 # If you need HEIC support, uncomment these lines (assuming pillow-heif is installed).
 from pillow_heif import register_heif_opener
 register_heif_opener()
 
-def detect_faces_and_save_to_json(image_folders, output_json, faces_folder):
+def detect_faces_in_image(image_path, detection_width=1600, model="hog", upsample=1):
+    """
+    Detect and encode the faces of one image. Runs in the worker processes.
+
+    Detection runs on a copy scaled down to detection_width pixels wide (the slow part on
+    12MP+ photos); the face boxes are then mapped back to full resolution, where the
+    encodings are computed and the faces cropped.
+    Returns a list of (box, encoding, face image) and the seconds spent in each stage.
+    """
+    timings = {}
+    start = time.perf_counter()
+    pil_image = Image.open(image_path).convert("RGB")
+    image_array = np.asarray(pil_image)
+    scale = min(1.0, detection_width / pil_image.width) if detection_width else 1.0
+    if scale < 1.0:
+        detection_image = pil_image.resize(
+            (detection_width, max(1, round(pil_image.height * scale))), Image.BILINEAR, reducing_gap=2.0
+        )
+        detection_array = np.asarray(detection_image)
+    else:
+        detection_array = image_array
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    face_locations = face_recognition.face_locations(detection_array, upsample, model)
+    face_locations = [
+        (
+            max(0, int(top / scale)),
+            min(pil_image.width, int(np.ceil(right / scale))),
+            min(pil_image.height, int(np.ceil(bottom / scale))),
+            max(0, int(left / scale)),
+        )
+        for top, right, bottom, left in face_locations
+    ]
+    timings["detect"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    face_encodings = face_recognition.face_encodings(image_array, face_locations)
+    faces = []
+    for face_location, face_encoding in zip(face_locations, face_encodings):
+        top, right, bottom, left = face_location
+        faces.append((face_location, face_encoding, pil_image.crop((left, top, right, bottom))))
+    timings["encode"] = time.perf_counter() - start
+    return faces, timings
+
+
+def manifest_path(output_json):
+    return os.path.splitext(output_json)[0] + "_manifest.json"
+
+
+def encodings_path(output_json):
+    """File with the encodings of the faces in output_json, one float32 row per face."""
+    return os.path.splitext(output_json)[0] + "_encodings.npy"
+
+
+def face_ids_path(encodings_file):
+    """File with the 'faceId' of every row of encodings_file."""
+    return os.path.splitext(encodings_file)[0] + "_face_ids.npy"
+
+
+def load_encodings(faces, encodings_file):
+    """
+    Encodings of faces and the row of each face ID in them: the memory-mapped encodings
+    file, looked up through its face IDs file, or, for JSON files written before encodings
+    were stored apart, a matrix built from their inline 'encoding' lists (which are left
+    in the faces). Faces without an encoding are left out of the rows.
+    """
+    if faces and "encoding" in faces[0]:
+        rows = {face["faceId"]: row for row, face in enumerate(faces)}
+        return np.array([face["encoding"] for face in faces], dtype=np.float32), rows
+    try:
+        face_ids = np.load(face_ids_path(encodings_file))
+        encodings = np.load(encodings_file, mmap_mode="r")
+    except (OSError, ValueError):
+        return np.zeros((0, 128), dtype=np.float32), {}
+    return encodings, {face_id: row for row, face_id in enumerate(face_ids.tolist())}
+
+
+def load_previous_run(output_json):
+    """
+    Faces of the previous run, by ID, their encodings, the row of each face ID in them and
+    the manifest: the size, mtime and faces (ID and box) of every processed image, plus
+    the next free face ID.
+    """
+    try:
+        with open(output_json, 'r', encoding='utf-8') as f:
+            faces = json.load(f)
+    except (OSError, ValueError):
+        faces = []
+    encodings, rows = load_encodings(faces, encodings_path(output_json))
+    for face in faces:
+        # The new run writes its own encodings files
+        face.pop("encoding", None)
+        face.pop("encodingIndex", None)
+    faces = {face["faceId"]: face for face in faces}
+    try:
+        with open(manifest_path(output_json), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {"nextFaceId": 0, "images": {}}
+    # New IDs must not reuse one of output_json, even if the manifest is missing or older
+    numbers = [int(face_id[5:]) for face_id in faces if face_id.startswith("face_") and face_id[5:].isdigit()]
+    manifest["nextFaceId"] = max(manifest["nextFaceId"], max(numbers, default=-1) + 1)
+    return faces, encodings, rows, manifest
+
+
+def box_overlap(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[1], b[1]) - max(a[3], b[3])
+    if height <= 0 or width <= 0:
+        return 0.0
+    intersection = height * width
+    return intersection / ((a[2] - a[0]) * (a[1] - a[3]) + (b[2] - b[0]) * (b[1] - b[3]) - intersection)
+
+
+def detect_faces_and_save_to_json(image_folders, output_json, faces_folder, workers=None, detection_width=1600,
+                                  model="hog", upsample=1, incremental=False, metrics=None, catalog_path=catalog_file,
+                                  tolerance=0.6):
     """
     Recursively traverse multiple folders with images,
     detect faces, and save them in a JSON file.
     Each face is assigned a unique ID and placeholders for 'personName'.
 
+    Images are decoded and analyzed by a pool of processes while this process keeps
+    walking the folders, saving the cropped faces and writing the JSON. Results are
+    consumed in the order images were found, so face IDs don't depend on timing.
+
+    Face encodings are saved apart, as a float32 array in <output>_encodings.npy, with
+    the 'faceId' of each row in <output>_encodings_face_ids.npy.
+    A manifest of the processed images is saved next to output_json as well. With incremental,
+    images whose size and mtime haven't changed since the previous run keep their faces
+    as they are, including 'personName' and 'isConfirmed'; only new or changed images
+    are analyzed. Faces found again in a changed image (same place) keep their ID and
+    labels, new faces get IDs never used before, and faces of deleted images are dropped.
+    Labeled faces of a changed image that are not found again are kept as they were.
+    For an output written before the manifest existed, the faces of each image are matched
+    by encoding (within tolerance) against the previous faces of the same 'originalImage';
+    previous faces that don't match are kept, and labeled faces of images that were not
+    found are kept as well, so no label or crop is lost on the first incremental run.
+    The folders are listed through the shared library catalog (photo_catalog.py), which
+    gives the size and mtime of every image in a single os.scandir pass.
+
     :param image_folders: List of folders to search for images (including subdirectories).
     :param output_json: Name of the JSON file to store face data.
     :param faces_folder: Folder where cropped face images will be saved.
+    :param workers: Detection processes (one per core by default).
+    :param detection_width: Width of the downscaled copy faces are detected on (0 = full resolution).
+    :param incremental: Only analyze images that are new or changed since the previous run.
+    :param metrics: instrumentation.Metrics collecting stage times and counters.
+    :param catalog_path: Library catalog shared with the other scripts ('' to not save it).
+    :param tolerance: Maximum encoding distance to match a face with one of an output without manifest.
     """
     os.makedirs(faces_folder, exist_ok=True)
+    metrics = metrics or Metrics("detect_faces")
 
-    all_faces = []
-    face_id_counter = 0
+    if incremental:
+        previous_faces, previous_encodings, previous_rows, previous_manifest = load_previous_run(output_json)
+    else:
+        previous_faces, previous_encodings, previous_rows = {}, None, {}
+        previous_manifest = {"nextFaceId": 0, "images": {}}
+    encodings = []
+    face_ids = []
+    previous_images = previous_manifest["images"]
+    # Previous faces no manifest entry knows about (outputs written before the manifest), by image
+    listed = {face_id for image in previous_images.values() for face_id, *_ in image["faces"]}
+    unlisted = {}
+    for face_id, face in previous_faces.items():
+        if face_id not in listed and face_id in previous_rows:
+            unlisted.setdefault(face["originalImage"], []).append(face_id)
+    manifest = {"nextFaceId": previous_manifest["nextFaceId"], "images": {}}
+    written_faces = set()
+    image_count = 0
+    reused_count = 0
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
 
     # Allowed extensions: add .heic, .heif if you want
     allowed_extensions = (".jpg", ".jpeg", ".png", ".heic", ".heif")
 
-    for folder in image_folders:
-        print(f"Processing folder: {folder}")
-        for root, dirs, files in os.walk(folder):
-            print(f"  Visiting subfolder: {root}")
-            for filename in files:
-                if not filename.lower().endswith(allowed_extensions):
-                    continue  # Skip non-image files
-
-                image_path = os.path.join(root, filename)
-                print(f"    Found image: {image_path}")
-                try:
-                    pil_image = Image.open(image_path)
-                    image_array = np.array(pil_image.convert("RGB"))
-
-                    # Detect faces
-                    face_locations = face_recognition.face_locations(image_array)
-                    face_encodings = face_recognition.face_encodings(image_array, face_locations)
-
-                    if not face_locations:
-                        print(f"      No faces detected in {filename}")
-                    else:
-                        print(f"      Detected {len(face_locations)} face(s) in {filename}")
-
-                    for face_location, face_encoding in zip(face_locations, face_encodings):
-                        top, right, bottom, left = face_location
-
-                        # Create a unique ID for each face
-                        face_id = f"face_{face_id_counter}"
-                        face_id_counter += 1
-
-                        # Extract the face and save it as a separate image
-                        face_image = pil_image.crop((left, top, right, bottom))
-                        face_filename = os.path.join(faces_folder, f"{face_id}.png")
-                        face_image.save(face_filename)
-
-                        # Convert face_encoding (numpy array) to list
-                        face_encoding_list = face_encoding.tolist()
-
-                        face_info = {
-                            "faceId": face_id,
-                            "originalImage": os.path.relpath(image_path, folder),
-                            "faceImage": os.path.relpath(face_filename, faces_folder),
-                            "encoding": face_encoding_list,
-                            "personName": "",
-                            "isConfirmed": False
-                        }
-                        all_faces.append(face_info)
-
-                except Exception as e:
-                    print(f"Error processing file {image_path}: {e}")
-
-    # Save all detected faces into a single JSON
-    with open(output_json, 'w', encoding='utf-8') as f:
-        json.dump(all_faces, f, indent=4)
-
+    def write_face(face_info, encoding, json_file):
+        face_ids.append(face_info["faceId"])
+        encodings.append(np.asarray(encoding, dtype=np.float32))
+        # Faces are appended to the JSON array as they come, laid out as json.dump(indent=4) would
+        json_file.write(",\n" if written_faces else "\n")
+        json_file.write(textwrap.indent(json.dumps(face_info, indent=4), "    "))
+        written_faces.add(face_info["faceId"])
+
+    def keep_previous(key, previous_image, json_file):
+        manifest["images"][key] = previous_image
+        for face_id, *_ in previous_image["faces"]:
+            if face_id in previous_faces and face_id in previous_rows:
+                write_face(previous_faces[face_id], previous_encodings[previous_rows[face_id]], json_file)
+
+    def match_previous(face_location, face_encoding, unmatched):
+        """ID of the previous face that is the same face: same place or, without a box, same encoding."""
+        overlaps = {face_id: box_overlap(face_location, box) for face_id, box in unmatched.items() if box}
+        face_id = max(overlaps, key=overlaps.get, default=None)
+        if face_id is not None and overlaps[face_id] >= 0.5:
+            return face_id
+        unboxed = [face_id for face_id, box in unmatched.items() if not box and face_id in previous_rows]
+        if not unboxed:
+            return None
+        distances = squared_distances(
+            np.asarray(face_encoding, dtype=np.float32)[None, :],
+            np.asarray(previous_encodings[[previous_rows[face_id] for face_id in unboxed]], dtype=np.float32),
+        )[0]
+        nearest = distances.argmin()
+        return unboxed[nearest] if distances[nearest] <= tolerance * tolerance else None
+
+    def save_faces(folder, image_path, photo, future, json_file):
+        nonlocal image_count, reused_count
+        key = os.path.abspath(image_path)
+        previous_image = previous_images.get(key)
+        if previous_image is None:
+            # Faces of an output without manifest: no box recorded, only their encoding
+            previous_image = {"faces": [[face_id] for face_id in unlisted.pop(os.path.relpath(image_path, folder), [])]}
+        if future is None:
+            # Unchanged since the previous run
+            reused_count += 1
+            metrics.count("cache_hits")
+            keep_previous(key, previous_image, json_file)
+            return
+
+        try:
+            faces, image_timings = future.result()
+        except Exception as e:
+            print(f"Error processing file {image_path}: {e}")
+            metrics.count("errors")
+            if key in previous_images:
+                # Keep what the previous run found; the image is retried next run, as its size or mtime changed
+                keep_previous(key, previous_image, json_file)
+            else:
+                # Not in the manifest yet, so it is retried next run too
+                for face_id, *_ in previous_image["faces"]:
+                    write_face(previous_faces[face_id], previous_encodings[previous_rows[face_id]], json_file)
+            return
+        image_count += 1
+        metrics.count("images_analyzed")
+        metrics.count("bytes_read", photo["size"])
+        metrics.count("faces_detected", len(faces))
+        for stage, seconds in image_timings.items():
+            metrics.add_time(stage, seconds)
+        metrics.progress("Images analyzed", image_count)
+
+        start = time.perf_counter()
+        unmatched = {face_id: box for face_id, *box in previous_image["faces"]}
+        image_faces = []
+        for face_location, face_encoding, face_image in faces:
+            # Keep the ID of the same face found by the previous run, or create a new one
+            face_id = match_previous(face_location, face_encoding, unmatched)
+            if face_id is None:
+                face_id = f"face_{manifest['nextFaceId']}"
+                manifest["nextFaceId"] += 1
+                previous_face = {}
+            else:
+                del unmatched[face_id]
+                previous_face = previous_faces.get(face_id, {})
+
+            # Save the extracted face as a separate image
+            face_filename = os.path.join(faces_folder, f"{face_id}.png")
+            face_image.save(face_filename)
+
+            write_face({
+                "faceId": face_id,
+                "originalImage": os.path.relpath(image_path, folder),
+                "faceImage": os.path.relpath(face_filename, faces_folder),
+                "personName": previous_face.get("personName", ""),
+                "isConfirmed": previous_face.get("isConfirmed", False)
+            }, face_encoding, json_file)
+            image_faces.append([face_id, *face_location])
+        for face_id, box in unmatched.items():
+            # Never drop a labeled face, nor one of an output without manifest, that wasn't found again
+            face = previous_faces.get(face_id)
+            if face is not None and face_id in previous_rows and (face["personName"] or not box):
+                write_face(face, previous_encodings[previous_rows[face_id]], json_file)
+                image_faces.append([face_id, *box])
+        manifest["images"][key] = {"size": photo["size"], "mtime": photo["mtime"], "faces": image_faces}
+        metrics.add_time("save", time.perf_counter() - start)
+
+    with open(output_json + ".tmp", 'w', encoding='utf-8') as json_file, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        json_file.write("[")
+        pending = deque()
+        print(f"Processing folders: {', '.join(image_folders)}")
+        images = iter(scan_library(image_folders, catalog_path, extensions=allowed_extensions, metrics=metrics))
+        while True:
+            # Keep a few images per worker queued, so decoding never waits for the next submissions
+            start = time.perf_counter()
+            while len(pending) < workers * 4:
+                folder, image_path, photo = next(images, (None, None, None))
+                if image_path is None:
+                    break
+                previous_image = previous_images.get(os.path.abspath(image_path))
+                if (previous_image and (previous_image["size"], previous_image["mtime"]) == (photo["size"], photo["mtime"])
+                        and all(face_id in previous_rows for face_id, *_ in previous_image["faces"])):
+                    future = None
+                else:
+                    metrics.count("cache_misses")
+                    future = executor.submit(detect_faces_in_image, image_path, detection_width, model, upsample)
+                pending.append((folder, image_path, photo, future))
+            metrics.add_time("submit", time.perf_counter() - start)
+            if not pending:
+                break
+            save_faces(*pending.popleft(), json_file)
+        # Labeled faces of an output without manifest whose image wasn't found: kept until it is
+        for face_ids_left in unlisted.values():
+            for face_id in face_ids_left:
+                if previous_faces[face_id]["personName"]:
+                    write_face(previous_faces[face_id], previous_encodings[previous_rows[face_id]], json_file)
+        json_file.write("\n]" if written_faces else "]")
+    metrics.progress("Images analyzed", image_count, force=True)
+    os.replace(output_json + ".tmp", output_json)
+    del previous_encodings
+    with open(encodings_path(output_json) + ".tmp", 'wb') as f:
+        np.save(f, np.array(encodings, dtype=np.float32).reshape(len(encodings), 128))
+    os.replace(encodings_path(output_json) + ".tmp", encodings_path(output_json))
+    ids_file = face_ids_path(encodings_path(output_json))
+    with open(ids_file + ".tmp", 'wb') as f:
+        np.save(f, np.array(face_ids, dtype=str))
+    os.replace(ids_file + ".tmp", ids_file)
+    with open(manifest_path(output_json), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    # Crops of faces that are gone (deleted images, or faces no longer found in a changed image)
+    for face_id in set(previous_faces) - written_faces:
+        try:
+            os.remove(os.path.join(faces_folder, f"{face_id}.png"))
+        except OSError:
+            pass
+
+    elapsed = time.perf_counter() - start_time
     print(f"Faces have been analyzed and stored in {output_json}")
+    print(f"{image_count} images analyzed, {reused_count} unchanged, {len(written_faces)} faces in {elapsed:.1f}s "
+          f"({image_count / elapsed if elapsed else 0:.2f} images/s, {workers} workers)")
+    print("Note: decode, detect and encode times are summed over all workers.")
+
 
+def squared_distances(a, b):
+    """Squared euclidean distances between the rows of a and b, as |a|² + |b|² - 2ab."""
+    distances = a @ b.T
+    distances *= -2
+    distances += (a * a).sum(axis=1)[:, None]
+    distances += (b * b).sum(axis=1)[None, :]
+    return distances
 
-def recategorize_faces_with_updated_json(updated_json):
+
+def propagate_labels(faces, encodings, rows, tolerance=0.6, batch_size=4096):
+    """
+    Give every face without a name the name of its closest confirmed face, if they are
+    within tolerance (face_recognition's usual threshold is 0.6). Suggested names are
+    left with isConfirmed False. rows gives the row of each face ID in encodings; faces
+    missing from it are ignored. Returns the number of faces named.
+    """
+    faces = [face for face in faces if face["faceId"] in rows]
+    confirmed = [face for face in faces if face["isConfirmed"] and face["personName"]]
+    unlabeled = [face for face in faces if not face["personName"]]
+    if not confirmed or not unlabeled:
+        return 0
+    known = np.asarray(encodings[[rows[face["faceId"]] for face in confirmed]], dtype=np.float32)
+    named = 0
+    for start in range(0, len(unlabeled), batch_size):
+        batch = unlabeled[start:start + batch_size]
+        distances = squared_distances(
+            np.asarray(encodings[[rows[face["faceId"]] for face in batch]], dtype=np.float32), known
+        )
+        nearest = distances.argmin(axis=1)
+        for face, index, distance in zip(batch, nearest, distances[np.arange(len(batch)), nearest]):
+            if distance <= tolerance * tolerance:
+                face["personName"] = confirmed[index]["personName"]
+                named += 1
+    return named
+
+
+def cluster_faces(faces, encodings, rows, tolerance=0.6, batch_size=2048):
+    """
+    Group the faces that still have no name: faces within tolerance of each other end up
+    in the same 'clusterId', so a whole cluster can be named at once. rows gives the row
+    of each face ID in encodings. Returns the number of clusters.
     """
-    Load the updated JSON (where a user has corrected/merged names, etc.)
-    and use it to refine categories or handle any custom logic you need.
+    unlabeled = [face for face in faces if not face["personName"] and face["faceId"] in rows]
+    matrix = np.asarray(encodings[[rows[face["faceId"]] for face in unlabeled]], dtype=np.float32)
+    parent = list(range(len(unlabeled)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Only the upper triangle of the distance matrix, one block of rows at a time
+    for start in range(0, len(unlabeled), batch_size):
+        distances = squared_distances(matrix[start:start + batch_size], matrix[start:])
+        pair_rows, pair_cols = np.nonzero(distances <= tolerance * tolerance)
+        for i, j in zip((pair_rows + start).tolist(), (pair_cols + start).tolist()):
+            if i < j:
+                parent[find(i)] = find(j)
+
+    clusters = {}
+    for i, face in enumerate(unlabeled):
+        clusters.setdefault(find(i), []).append(face)
+    for face in faces:
+        face.pop("clusterId", None)
+    cluster_count = 0
+    for members in clusters.values():
+        if len(members) > 1:
+            for face in members:
+                face["clusterId"] = f"cluster_{cluster_count}"
+            cluster_count += 1
+    return cluster_count
+
+
+def recategorize_faces_with_updated_json(updated_json, encodings_file, tolerance=0.6, cluster=False):
+    """
+    Load the updated JSON (where a user has corrected/merged names, etc.), name the
+    unlabeled faces that match a confirmed one and, with cluster, group the rest.
+    Encodings are looked up by face ID, so updated_json can be an older, edited copy
+    of the output; faces no longer in encodings_file are left as they are.
+    The suggestions are written back to updated_json.
     """
     if not os.path.exists(updated_json):
         print(f"Updated JSON file not found: {updated_json}")
@@ -114,12 +465,18 @@ def recategorize_faces_with_updated_json(updated_json):
     with open(updated_json, 'r', encoding='utf-8') as f:
         updated_data = json.load(f)
 
-    # Example logic (modify as you need)
-    for face_entry in updated_data:
-        face_id = face_entry["faceId"]
-        person_name = face_entry["personName"]
-        is_confirmed = face_entry["isConfirmed"]
-        print(f"Face {face_id} labeled as '{person_name}' (confirmed={is_confirmed})")
+    encodings, rows = load_encodings(updated_data, encodings_file)
+    start = time.perf_counter()
+    named = propagate_labels(updated_data, encodings, rows, tolerance)
+    print(f"{named} unlabeled face(s) named after a confirmed face")
+    if cluster:
+        cluster_count = cluster_faces(updated_data, encodings, rows, tolerance)
+        print(f"{cluster_count} cluster(s) of faces without a name")
+    print(f"Matched {len(updated_data)} faces in {time.perf_counter() - start:.1f}s")
+
+    with open(updated_json + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(updated_data, f, indent=4)
+    os.replace(updated_json + ".tmp", updated_json)
 
     print("Recategorization based on updated JSON complete.")
 
@@ -133,6 +490,25 @@ def main():
         nargs="+",
         help="One or more image folders, followed by output.json, faces_folder, and optionally updated.json."
     )
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes detecting faces in parallel (default: one per core)")
+    parser.add_argument("--detection-width", type=int, default=1600,
+                        help="Detect faces on a copy scaled down to this width; 0 to use full resolution")
+    parser.add_argument("--model", choices=("hog", "cnn"), default="hog",
+                        help="face_recognition detection model")
+    parser.add_argument("--upsample", type=int, default=1,
+                        help="Times the image is upsampled to find smaller faces")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only analyze new or changed images, keeping face IDs and labels of the previous run")
+    parser.add_argument("--tolerance", type=float, default=0.6,
+                        help="Maximum encoding distance for two faces to be the same person")
+    parser.add_argument("--cluster", action="store_true",
+                        help="With updated.json, also group the faces still without a name into clusters")
+    parser.add_argument("--catalog", default=catalog_file,
+                        help="Library catalog shared with mosaic.py and remove-duplicates.py ('' to not save it)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Save stage times, counters and peak memory to a JSON file")
+    parser.add_argument("--profile", metavar="FILE", help="Save a cProfile dump of the run")
 
     args = parser.parse_args()
     paths = args.paths
@@ -177,12 +553,19 @@ def main():
         output_json = paths[-3]
         images_folders = paths[:-3]
 
-    # 1) Detect faces
-    detect_faces_and_save_to_json(images_folders, output_json, faces_folder)
-
-    # 2) Optionally recategorize
-    if updated_json:
-        recategorize_faces_with_updated_json(updated_json)
+    with Metrics("face_recognition", args.metrics, args.profile) as metrics:
+        # 1) Detect faces
+        detect_faces_and_save_to_json(
+            images_folders, output_json, faces_folder, args.workers, args.detection_width, args.model, args.upsample,
+            args.incremental, metrics, args.catalog, args.tolerance,
+        )
+
+        # 2) Optionally recategorize
+        if updated_json:
+            with metrics.stage("recategorize"):
+                recategorize_faces_with_updated_json(
+                    updated_json, encodings_path(output_json), args.tolerance, args.cluster
+                )
 
 if __name__ == "__main__":
     main()
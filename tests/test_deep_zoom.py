@@ -0,0 +1,36 @@
+import math
+import os
+
+import pytest
+from PIL import Image
+
+from mosaic import DeepZoomWriter
+
+
+@pytest.mark.parametrize("size, band_height", [((1000, 600), 100), ((513, 777), 37), ((256, 256), 256)])
+def test_levels_and_tile_sizes(tmp_path, size, band_height):
+    dzi_path = str(tmp_path / "mosaic.dzi")
+    writer = DeepZoomWriter(dzi_path, size, tile_size=256, tile_format="png")
+    for top in range(0, size[1], band_height):
+        writer.add_band(Image.new("RGB", (size[0], min(band_height, size[1] - top)), (10, 20, 30)))
+    writer.close()
+
+    max_level = math.ceil(math.log2(max(size)))
+    files_folder = str(tmp_path / "mosaic_files")
+    assert sorted(map(int, os.listdir(files_folder))) == list(range(max_level + 1))
+    for level in range(max_level + 1):
+        # Cada nivel mide la mitad (redondeando hacia arriba) que el siguiente
+        scale = 2 ** (max_level - level)
+        width, height = -(-size[0] // scale), -(-size[1] // scale)
+        cols, rows = -(-width // 256), -(-height // 256)
+        names = sorted(os.listdir(os.path.join(files_folder, str(level))))
+        assert names == sorted(f"{col}_{row}.png" for col in range(cols) for row in range(rows))
+        for col in range(cols):
+            for row in range(rows):
+                with Image.open(os.path.join(files_folder, str(level), f"{col}_{row}.png")) as tile:
+                    assert tile.size == (min(256, width - col * 256), min(256, height - row * 256))
+
+    with open(dzi_path, encoding="utf-8") as f:
+        descriptor = f.read()
+    assert f'Width="{size[0]}" Height="{size[1]}"' in descriptor
+    assert 'TileSize="256"' in descriptor
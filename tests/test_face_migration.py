@@ -0,0 +1,82 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("face_recognition")
+pytest.importorskip("pillow_heif")
+import run_face_recognition  # noqa: E402
+
+
+def encoding(k, noise=0.0):
+    vector = np.zeros(128)
+    vector[k] = 1.0
+    return vector + noise
+
+
+# Faces found by the new run in each image: (box, encoding)
+detections = {
+    "a.jpg": [((10, 40, 40, 10), encoding(1, 0.01)), ((50, 90, 90, 50), encoding(0, 0.01))],
+    "b.jpg": [],
+    "c.jpg": [((5, 30, 30, 5), encoding(4))],
+}
+
+
+def fake_detect(image_path, detection_width=1600, model="hog", upsample=1):
+    faces = [(box, enc, Image.new("RGB", (8, 8))) for box, enc in detections[os.path.basename(image_path)]]
+    return faces, {}
+
+
+def test_first_incremental_run_keeps_ids_labels_and_crops(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_face_recognition, "detect_faces_in_image", fake_detect)
+    images = tmp_path / "images"
+    faces_folder = tmp_path / "faces"
+    images.mkdir()
+    faces_folder.mkdir()
+    for name in detections:
+        Image.new("RGB", (100, 100)).save(images / name)
+    # Output of the script before the manifest: inline encodings, no boxes
+    legacy = [
+        ("face_0", "a.jpg", encoding(0), "Ana"),
+        ("face_1", "a.jpg", encoding(1), ""),
+        ("face_2", "b.jpg", encoding(2), "Bo"),
+        ("face_3", "gone.jpg", encoding(3), "Cy"),
+        ("face_4", "gone.jpg", encoding(5), ""),
+    ]
+    output_json = str(tmp_path / "faces.json")
+    with open(output_json, "w", encoding="utf-8") as f:
+        json.dump([
+            {"faceId": face_id, "originalImage": image, "faceImage": f"{face_id}.png", "encoding": enc.tolist(),
+             "personName": name, "isConfirmed": bool(name)}
+            for face_id, image, enc, name in legacy
+        ], f)
+    for face_id, *_ in legacy:
+        Image.new("RGB", (8, 8)).save(faces_folder / f"{face_id}.png")
+
+    run_face_recognition.detect_faces_and_save_to_json(
+        [str(images)], output_json, str(faces_folder), workers=1, incremental=True, catalog_path=""
+    )
+
+    with open(output_json, encoding="utf-8") as f:
+        faces = {face["faceId"]: face for face in json.load(f)}
+    labels = {face_id: (face["originalImage"], face["personName"]) for face_id, face in faces.items()}
+    assert labels == {
+        "face_0": ("a.jpg", "Ana"),   # matched by encoding, though detected in another order
+        "face_1": ("a.jpg", ""),
+        "face_2": ("b.jpg", "Bo"),    # not detected again, but never dropped
+        "face_3": ("gone.jpg", "Cy"),  # labeled face of an image not found
+        "face_5": ("c.jpg", ""),      # new IDs start above the existing ones
+    }
+    assert sorted(os.listdir(faces_folder)) == [f"face_{n}.png" for n in (0, 1, 2, 3, 5)]
+
+    # The next run finds everything unchanged and keeps the same faces
+    run_face_recognition.detect_faces_and_save_to_json(
+        [str(images)], output_json, str(faces_folder), workers=1, incremental=True, catalog_path=""
+    )
+    with open(output_json, encoding="utf-8") as f:
+        assert {face["faceId"]: face for face in json.load(f)} == faces
+    encodings, rows = run_face_recognition.load_encodings(list(faces.values()),
+                                                          run_face_recognition.encodings_path(output_json))
+    np.testing.assert_allclose(encodings[rows["face_0"]], encoding(0, 0.01), rtol=1e-6)
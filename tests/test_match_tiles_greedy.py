@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from mosaic import match_tiles_greedy
+
+
+def match_tiles_loop(cell_colors, tile_colors):
+    """El bucle original de mosaic.py: para cada celda, la tesela libre más cercana."""
+    used_tiles = set()
+    assignment = []
+    for base_color in cell_colors:
+        closest_tile_idx = -1
+        min_distance = float('inf')
+        for idx, tile_color in enumerate(tile_colors):
+            if idx in used_tiles:
+                continue
+            distance = np.linalg.norm(np.array(tile_color) - np.array(base_color))
+            if distance < min_distance:
+                min_distance = distance
+                closest_tile_idx = idx
+        if closest_tile_idx >= 0:
+            used_tiles.add(closest_tile_idx)
+        assignment.append(closest_tile_idx)
+    return np.array(assignment)
+
+
+@pytest.mark.parametrize("cells, tiles, candidates", [(60, 80, 16), (80, 60, 16), (50, 50, 4), (40, 70, 100)])
+def test_same_assignment_as_loop(cells, tiles, candidates):
+    rng = np.random.default_rng(cells * tiles)
+    cell_colors = rng.random((cells, 3)) * 255
+    tile_colors = rng.random((tiles, 3)) * 255
+    assignment = match_tiles_greedy(cell_colors, tile_colors, candidates)
+    np.testing.assert_array_equal(assignment, match_tiles_loop(cell_colors, tile_colors))
+
+
+def test_ties_go_to_lowest_index():
+    # Pocos colores distintos: casi todas las distancias empatan
+    rng = np.random.default_rng(0)
+    cell_colors = rng.integers(0, 3, (70, 3)).astype(float)
+    tile_colors = rng.integers(0, 3, (90, 3)).astype(float)
+    assignment = match_tiles_greedy(cell_colors, tile_colors, candidates=4)
+    np.testing.assert_array_equal(assignment, match_tiles_loop(cell_colors, tile_colors))
@@ -0,0 +1,52 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# remove-duplicates.py no se puede importar por su nombre
+spec = importlib.util.spec_from_file_location(
+    "remove_duplicates", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "remove-duplicates.py")
+)
+remove_duplicates = importlib.util.module_from_spec(spec)
+sys.modules["remove_duplicates"] = remove_duplicates
+spec.loader.exec_module(remove_duplicates)
+
+
+def brute_force_pairs(hashes, max_distance):
+    return {
+        (i, j)
+        for i in range(len(hashes))
+        for j in range(i + 1, len(hashes))
+        if bin(int(hashes[i]) ^ int(hashes[j])).count("1") <= max_distance
+    }
+
+
+@pytest.mark.parametrize("max_distance", [0, 1, 4, 6, 10])
+def test_same_pairs_as_brute_force(max_distance):
+    rng = np.random.default_rng(max_distance)
+    bases = rng.integers(0, 2 ** 63, 40, dtype=np.uint64) * np.uint64(2) + rng.integers(0, 2, 40, dtype=np.uint64)
+    # Variantes de cada hash con unos pocos bits cambiados, cerca y lejos del límite
+    variants = []
+    for base in bases:
+        for flips in rng.integers(0, max_distance + 3, 4):
+            mask = 0
+            for bit in rng.choice(64, flips, replace=False):
+                mask |= 1 << int(bit)
+            variants.append(int(base) ^ mask)
+    hashes = np.array(list(bases) + variants, dtype=np.uint64)
+    hashes = hashes[rng.permutation(len(hashes))]
+    assert remove_duplicates.near_duplicate_pairs(hashes, max_distance) == brute_force_pairs(hashes, max_distance)
+
+
+def test_large_bucket_in_row_blocks():
+    # Muchos hashes con el mismo trozo (como muchas fotos lisas) caen en un solo tramo
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2 ** 63, 1500, dtype=np.uint64) & ~np.uint64(0x1FF)
+    hashes[500:520] = hashes[0] ^ np.uint64(1 << 40)
+    distances = remove_duplicates.hamming_distances(hashes[:, None], hashes[None, :])
+    first, second = np.nonzero(np.triu(distances <= 6, k=1))
+    expected = set(zip(first.tolist(), second.tolist()))
+    assert len(expected) > 200
+    assert remove_duplicates.near_duplicate_pairs(hashes, 6) == expected
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from mosaic import schedule_repeats
+
+
+def same_tile_nearby(assignment, min_distance):
+    """Número de pares de celdas con la misma tesela a menos de min_distance en filas y columnas."""
+    rows, cols = assignment.shape
+    radius = min_distance - 1
+    padded = np.pad(assignment, radius, constant_values=-1)
+    clashes = 0
+    for dr in range(-radius, radius + 1):
+        for dc in range(-radius, radius + 1):
+            if (dr, dc) != (0, 0):
+                shifted = padded[radius + dr:radius + dr + rows, radius + dc:radius + dc + cols]
+                clashes += int((shifted == assignment).sum())
+    return clashes // 2
+
+
+@pytest.mark.parametrize("rows, cols, tiles, max_uses, min_distance", [
+    (30, 40, 200, 8, 3),
+    (25, 25, 60, 12, 4),
+    (20, 30, 100, None, 2),
+])
+def test_constraints_when_feasible(rows, cols, tiles, max_uses, min_distance):
+    rng = np.random.default_rng(rows * cols)
+    assignment = np.full((rows, cols), -1)
+    # Una parte ya asignada sin repetir, como la deja match_tiles_greedy
+    assignment.ravel()[:tiles // 2] = rng.permutation(tiles)[:tiles // 2]
+    cell_colors = rng.random((rows * cols, 3)) * 255
+    tile_colors = rng.random((tiles, 3)) * 255
+
+    result, relaxed = schedule_repeats(assignment, cell_colors, tile_colors, max_uses, min_distance)
+    assert relaxed == 0
+    assert (result >= 0).all()
+    np.testing.assert_array_equal(result.ravel()[:tiles // 2], assignment.ravel()[:tiles // 2])
+    limit = max_uses if max_uses is not None else -(-rows * cols // tiles)
+    assert np.bincount(result.ravel(), minlength=tiles).max() <= limit
+    assert same_tile_nearby(result, min_distance) == 0
+
+
+def test_relaxed_cells_respect_remaining_uses():
+    # Cinco teselas no pueden separarse 3 celdas: casi todo se relaja, pero los usos
+    # justos para cubrir el grid no deben pasarse mientras queden teselas con usos libres
+    rng = np.random.default_rng(0)
+    assignment = np.full((60, 60), -1)
+    result, relaxed = schedule_repeats(assignment, rng.random((3600, 3)) * 255, rng.random((5, 3)) * 255, 720, 3)
+    assert relaxed > 0
+    assert (result >= 0).all()
+    np.testing.assert_array_equal(np.bincount(result.ravel(), minlength=5), [720] * 5)
+
+
+def test_full_assignment_is_unchanged():
+    assignment = np.arange(12).reshape(3, 4)
+    result, relaxed = schedule_repeats(assignment, np.zeros((12, 3)), np.zeros((12, 3)))
+    np.testing.assert_array_equal(result, assignment)
+    assert relaxed == 0